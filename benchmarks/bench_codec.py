@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# bench_codec.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Micro-benchmark of Spur frame encoding and decoding.
+Compares spur_codec with the struct calls that spur_app_a used before it.
+Usage: python benchmarks/bench_codec.py [iterations]
+"""
+
+import os
+import sys
+import time
+import struct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import spur_codec
+
+FUNCTIONS = spur_codec.FUNCTIONS
+SPUR_ADDRESS = 0x0000
+CONFIG_DATA = struct.pack("cBcBcB", "S", 1, "R", 0, "F", 2) + "Y\x26C\x0cHello world\x00ES"
+RX_FRAMES = (
+    struct.pack(">HHBBI", 0, 0x0012, 0x09, 6, 0) + struct.pack(">H", 0x0001),
+    struct.pack(">HHBBI", 0, 0x0012, 0x07, 4, 0),
+    struct.pack(">HHBBI", 0, 0x0000, 0x00, 8, 0) + struct.pack(">I", 0x01020304),
+    struct.pack(">HHBBI", 0, 0x0012, 0x08, 4, 0)
+)
+
+def legacyEncode(destination, function, wakeupInterval, data=None):
+    timeStamp = 0x00000000
+    m = ""
+    m += struct.pack(">H", destination)
+    m += struct.pack(">H", SPUR_ADDRESS)
+    if function != "beacon":
+        length = 4
+        if data:
+            length += len(data)
+        m+= struct.pack("B", FUNCTIONS[function])
+        m+= struct.pack("B", length)
+        m+= struct.pack("I", timeStamp)
+        m+= struct.pack(">H", wakeupInterval)
+    if data:
+        m += data
+    m.encode("hex")     # The debug line was always built
+    return m
+
+def legacyDecode(message):
+    destination = struct.unpack(">H", message[0:2])[0]
+    source, hexFunction, length = struct.unpack(">HBB", message[2:6])
+    try:
+        function = (key for key,value in FUNCTIONS.items() if value==hexFunction).next()
+    except:
+        function = "undefined"
+    if function == "include_req":
+        struct.unpack(">I", message[10:14])[0]
+    elif function == "alert":
+        struct.unpack(">H", message[10:12])[0]
+    return function
+
+def codecEncode(destination, function, wakeupInterval, data=None):
+    return spur_codec.encode(destination, SPUR_ADDRESS, function, wakeupInterval, data)
+
+def codecDecode(message):
+    destination, source, function, length, payload = spur_codec.decodeHeader(message)
+    if function == "include_req":
+        spur_codec.NODE_ID.unpack_from(payload)[0]
+    elif function == "alert":
+        spur_codec.ALERT_TYPE.unpack_from(payload)[0]
+    return function
+
+def checkEquivalent():
+    for args in ((0x12, "ack", 300), (0x12, "config", 0, CONFIG_DATA), (0xBBBB, "beacon", 0)):
+        if legacyEncode(*args) != codecEncode(*args):
+            raise AssertionError("Encoders differ for " + str(args[1]))
+    for frame in RX_FRAMES:
+        if legacyDecode(frame) != codecDecode(frame):
+            raise AssertionError("Decoders differ for " + frame.encode("hex"))
+
+def rate(f, argsList, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        for args in argsList:
+            f(*args)
+    return iterations * len(argsList) / (time.time() - start)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    checkEquivalent()
+    txArgs = ((0x12, "ack", 300), (0x12, "config", 0, CONFIG_DATA), (0x0013, "send_battery", 7200))
+    rxArgs = [(f,) for f in RX_FRAMES]
+    results = (
+        ("encode", rate(legacyEncode, txArgs, iterations), rate(codecEncode, txArgs, iterations)),
+        ("decode", rate(legacyDecode, rxArgs, iterations), rate(codecDecode, rxArgs, iterations))
+    )
+    print("{:<8}{:>16}{:>16}{:>10}".format("", "legacy frames/s", "codec frames/s", "speedup"))
+    for name, legacy, codec in results:
+        print("{:<8}{:>16.0f}{:>16.0f}{:>9.2f}x".format(name, legacy, codec, codec/legacy))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# loadtest.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Load test of spur_app_a against simulated Spur buttons, radio adaptor and cloud client.
+Buttons ask to be included, receive their config, then wake up and get pressed on
+random schedules. The app runs on a virtual clock, so a long run takes only as long
+as the app's own processing.
+Buttons are spread over one or more radio adaptors and only hear the adaptor they are near.
+Usage: python benchmarks/loadtest.py --buttons 1000 --duration 3600 --loss 0.05 --adaptors 2
+"""
+
+import os
+import sys
+import json
+import random
+import base64
+import struct
+import shutil
+import argparse
+import tempfile
+import collections
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+import standins
+
+ADAPTOR_ID      = "ADT{}"
+GRANT_ADDRESS   = 0xBB00
+BEACON_ADDRESS  = 0xBBBB
+RADIO_DELAY     = 0.02          # Seconds between a frame being sent and received
+ACK_DELAY       = 0.05          # Seconds a button takes to ack a frame
+AWAKE_WINDOW    = 10            # Seconds a button listens after its last frame
+RESEND_TIMEOUT  = 3             # Seconds a button waits for an ack before resending
+RESENDS         = 3
+INCLUDE_RETRY   = 30            # Seconds a button waits for an include_grant before asking again
+IDLE_SLEEP      = 300           # Seconds a button sleeps after its awake window ends without an ack
+CLOUD_DELAY     = 0.5           # Seconds the cloud takes to answer an include_req
+STALL           = 0.005         # Seconds a callback may hold the reactor before it counts as a stall
+BULK_LAYOUT     = "Site update\nYes | No"     # Screen sent to every button by --bulk-at
+LAYOUTS = (
+    "Press for service\nLeft | Right",
+    "Meeting room\nCoffee | Tea\nWater | Snacks",
+    "Report a problem\nCleaning\nSupplies | Fault"
+)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class Button(object):
+    def __init__(self, harness, nodeID, adaptor):
+        self.harness = harness
+        self.nodeID = nodeID
+        self.adaptor = adaptor
+        self.addr = None
+        self.awakeUntil = 0
+        self.awaiting = None            # (function, payload) sent and not yet acked
+        self.resendCall = None
+        self.sleepCall = None
+        self.idleCall = None
+        self.pressTimes = collections.deque()
+        self.included = False
+
+    def now(self):
+        return self.harness.reactor.seconds()
+
+    def stayAwake(self):
+        self.awakeUntil = self.now() + AWAKE_WINDOW
+        if self.idleCall and self.idleCall.active():
+            self.idleCall.cancel()
+        self.idleCall = self.harness.reactor.callLater(AWAKE_WINDOW, self.idle)
+
+    def idle(self):
+        self.idleCall = None
+        if self.addr is not None and not (self.sleepCall and self.sleepCall.active()):
+            self.sleepCall = self.harness.reactor.callLater(IDLE_SLEEP, self.wake)
+
+    def transmit(self, function, payload=""):
+        source = self.addr if self.addr is not None else 0
+        frame = struct.pack(">HHBBI", 0, source, function, 4 + len(payload), 0) + payload
+        self.stayAwake()
+        self.harness.radioToApp(frame, self.adaptor)
+
+    def sendUntilAcked(self, function, payload="", attempt=0):
+        self.awaiting = (function, payload)
+        self.transmit(function, payload)
+        self.resendCall = self.harness.reactor.callLater(RESEND_TIMEOUT, self.resend, attempt + 1)
+
+    def resend(self, attempt):
+        self.resendCall = None
+        if attempt > RESENDS:
+            self.awaiting = None        # Give up
+            self.pressTimes.clear()
+        elif self.awaiting:
+            self.harness.stats["button_resends"] += 1
+            self.sendUntilAcked(self.awaiting[0], self.awaiting[1], attempt)
+
+    def acked(self):
+        self.awaiting = None
+        if self.resendCall and self.resendCall.active():
+            self.resendCall.cancel()
+        self.resendCall = None
+
+    def includeRequest(self):
+        if self.addr is None:
+            self.transmit(0x00, struct.pack(">I", self.nodeID))
+            self.harness.reactor.callLater(INCLUDE_RETRY, self.includeRequest)
+
+    def press(self):
+        if self.included:
+            # A press whose every copy was lost is never answered, so stop waiting for it
+            self.pressTimes.clear()
+            presses = self.harness.pressTime[self.nodeID]
+            while presses and presses[0] < self.now() - RESEND_TIMEOUT * (RESENDS + 1):
+                presses.popleft()
+            self.pressTimes.append(self.now())
+            presses.append(self.now())
+            if self.sleepCall and self.sleepCall.active():
+                self.sleepCall.cancel()
+            self.sendUntilAcked(0x09, struct.pack(">H", random.choice((0x0000, 0x0001))))
+        self.harness.reactor.callLater(random.expovariate(1.0 / self.harness.pressInterval), self.press)
+
+    def wake(self):
+        self.sleepCall = None
+        if random.random() < self.harness.args.roam:
+            self.adaptor = random.choice(self.harness.adaptors)
+        self.sendUntilAcked(0x07)
+
+    def receive(self, function, wakeup, payload):
+        if self.now() > self.awakeUntil:
+            self.harness.stats["frames_missed_asleep"] += 1
+            return
+        self.stayAwake()
+        if function == 0x02:
+            first = self.addr is None
+            self.addr = struct.unpack(">H", payload[4:6])[0]
+            self.harness.byAddr[self.addr] = self
+            self.harness.reactor.callLater(ACK_DELAY, self.transmit, 0x08)
+            if first:
+                self.harness.reactor.callLater(1, self.wake)     # Ask for config
+        elif function == 0x08:
+            self.acked()
+            if self.pressTimes:
+                self.harness.pressToAck.append(self.now() - self.pressTimes.popleft())
+                self.pressTimes.clear()
+            if wakeup > 0:
+                self.awakeUntil = 0
+                if self.idleCall and self.idleCall.active():
+                    self.idleCall.cancel()
+                if self.sleepCall and self.sleepCall.active():
+                    self.sleepCall.cancel()
+                self.sleepCall = self.harness.reactor.callLater(wakeup * 2, self.wake)
+        elif function in (0x05, 0x06, 0x0B):
+            if function == 0x05:
+                self.harness.configReceived(self.nodeID)
+            if function == 0x0B and not self.included:
+                self.included = True
+                self.harness.stats["buttons_included"] += 1
+                self.harness.reactor.callLater(random.expovariate(1.0 / self.harness.pressInterval), self.press)
+                if random.random() < self.harness.args.push_fraction:
+                    self.harness.reactor.callLater(random.expovariate(1.0 / self.harness.args.push_interval), self.harness.push, self.nodeID)
+            self.harness.reactor.callLater(ACK_DELAY, self.transmit, 0x08)
+
+class Harness(object):
+    def __init__(self, args):
+        self.args = args
+        self.verbose = args.verbose
+        self.pressInterval = args.press_interval
+        self.stats = collections.Counter()
+        self.rxFunctions = collections.Counter()
+        self.pressTime = collections.defaultdict(collections.deque)
+        self.pressToUplink = []
+        self.pressToAck = []
+        self.configVersion = collections.Counter()
+        self.pushTime = {}              # Node id to time of the oldest config push not yet received
+        self.pushToConfig = []
+        self.bulkLayout = None          # Screen every button has been sent by a bulk push
+        self.bulkProgress = []          # (seconds after the bulk push, nodes done, nodes) from config_progress messages
+        self.queueDepth = []
+        self.tickTimes = []
+        self.handlerTimes = collections.defaultdict(float)
+        self.handlerCalls = collections.Counter()
+        self.byAddr = {}
+        self.byNodeID = {}
+        self.configDir = tempfile.mkdtemp(prefix="spur_loadtest_")
+        with open(os.path.join(self.configDir, "spur_app.config"), "w") as f:
+            f.write(args.app_config)
+        self.reactor = standins.install(self, self.configDir)
+
+    def lost(self):
+        return random.random() < self.args.loss
+
+    # Radio, buttons to app
+    def radioToApp(self, frame, adaptor):
+        if self.lost():
+            self.stats["rx_frames_lost"] += 1
+            return
+        self.reactor.callLater(RADIO_DELAY, self.deliverToApp, frame, adaptor)
+
+    def deliverToApp(self, frame, adaptor):
+        self.stats["rx_frames"] += 1
+        self.rxFunctions[ord(frame[4])] += 1
+        self.app.onAdaptorData({"id": adaptor, "characteristic": "spur", "data": base64.b64encode(frame)})
+
+    # Radio, app to buttons
+    def onAppMessage(self, msg, destination):
+        if "data" not in msg:
+            return
+        frame = base64.b64decode(msg["data"])
+        self.stats["tx_frames"] += 1
+        self.stats["tx_bytes"] += len(frame)
+        address = struct.unpack(">H", frame[0:2])[0]
+        if address == BEACON_ADDRESS:
+            self.stats["tx_beacons"] += 1
+            return
+        if self.lost():
+            self.stats["tx_frames_lost"] += 1
+            return
+        function, wakeup = struct.unpack(">BxxxxxH", frame[4:12])
+        payload = frame[12:]
+        if address == GRANT_ADDRESS:
+            button = self.byNodeID.get(struct.unpack(">I", payload[0:4])[0])
+        else:
+            button = self.byAddr.get(address)
+        if button and button.adaptor == destination:
+            self.reactor.callLater(RADIO_DELAY, button.receive, function, wakeup, payload)
+        elif button:
+            self.stats["tx_frames_out_of_range"] += 1
+
+    # Cloud client
+    def onUplink(self, msg):
+        messages = msg["messages"] if msg.get("function") == "batch" else [msg]
+        self.stats["uplink_sends"] += 1
+        for m in messages:
+            function = m.get("function", m.get("status"))
+            self.stats["uplink_" + str(function)] += 1
+            if function == "include_req":
+                self.reactor.callLater(CLOUD_DELAY, self.grant, m["include_req"])
+            elif function == "config_progress":
+                self.bulkProgress.append((self.reactor.seconds() - self.bulkTime, m["done"], m["total"]))
+            elif function == "alert":
+                presses = self.pressTime[m["source"]]
+                if presses:
+                    self.pressToUplink.append(self.reactor.seconds() - presses.popleft())
+
+    def config(self, nodeID):
+        return {
+            "name": "Button " + str(nodeID),
+            "D1": base64.b64encode(self.bulkLayout or LAYOUTS[nodeID % len(LAYOUTS)]),
+            "S1": {"state": 1, "alert": 1, "SingleLeft": 2, "SingleRight": 2},
+            "S2": {"state": 2, "alert": 0, "DoubleLeft": 1},
+            "app_value": 1 + self.configVersion[nodeID]
+        }
+
+    def grant(self, nodeID):
+        self.app.client.receive({"function": "include_grant", "node": nodeID})
+        self.reactor.callLater(CLOUD_DELAY, self.app.client.receive, {"function": "config", "node": nodeID, "config": self.config(nodeID)})
+
+    def push(self, nodeID):
+        """ The cloud changes one config item of an included button. """
+        self.configVersion[nodeID] += 1
+        self.pushTime.setdefault(nodeID, self.reactor.seconds())
+        self.app.client.receive({"function": "config", "node": nodeID, "config": self.config(nodeID)})
+        self.reactor.callLater(random.expovariate(1.0 / self.args.push_interval), self.push, nodeID)
+
+    def bulkPush(self):
+        """ The cloud sends one new screen to every included button, in one message. """
+        self.bulkLayout = BULK_LAYOUT
+        self.bulkTime = self.reactor.seconds()
+        nodes = [nodeID for nodeID, button in sorted(self.byNodeID.items()) if button.included]
+        self.app.client.receive({"function": "config", "id": "bulk", "nodes": nodes, "config": {"D1": base64.b64encode(BULK_LAYOUT)}})
+
+    def configReceived(self, nodeID):
+        if nodeID in self.pushTime:
+            self.pushToConfig.append(self.reactor.seconds() - self.pushTime.pop(nodeID))
+
+    def timed(self, name, f):
+        def wrapper(*args, **kw):
+            start = standins.wallclock()
+            try:
+                return f(*args, **kw)
+            finally:
+                self.handlerTimes[name] += standins.wallclock() - start
+                self.handlerCalls[name] += 1
+        return wrapper
+
+    def tick(self):
+        """ Wraps App.beacon, which runs once a second. """
+        start = standins.wallclock()
+        self.appBeacon()
+        self.tickTimes.append(standins.wallclock() - start)
+        self.queueDepth.append(self.appQueueDepth())
+
+    def appQueueDepth(self):
+        if hasattr(self.app, "radios"):
+            return sum(len(radio.queue) for radio in self.app.radios.values())
+        return len(getattr(self.app, "radioQueue", None) or getattr(self.app, "messageQueue", []))
+
+    def start(self):
+        import spur_app_a
+        self.app = spur_app_a.App(["spur_app", "AID1"])
+        for name in ("onRadioMessage", "sendQueued", "sendConfig", "configRendered", "onClientMessage", "save"):
+            if hasattr(self.app, name):
+                setattr(self.app, name, self.timed(name, getattr(self.app, name)))
+        self.appBeacon = self.app.beacon
+        self.app.beacon = self.tick
+        self.app.onConfigureMessage({})
+        self.adaptors = [ADAPTOR_ID.format(i + 1) for i in range(self.args.adaptors)]
+        for adaptor in self.adaptors:
+            self.app.onAdaptorService({"id": adaptor, "service": [{"characteristic": "spur"}]})
+        if self.args.bulk_at:
+            self.reactor.callLater(self.args.bulk_at, self.bulkPush)
+        if self.args.profile_at:
+            request = {"function": "profile", "duration": self.args.profile_duration, "sample": self.args.profile_sample, "report": "manager"}
+            self.reactor.callLater(self.args.profile_at, self.app.client.receive, request)
+        for i in range(self.args.buttons):
+            nodeID = 0x10000000 + i
+            button = Button(self, nodeID, self.adaptors[i % len(self.adaptors)])
+            self.byNodeID[nodeID] = button
+            self.reactor.callLater(10 + random.uniform(0, self.args.ramp), button.includeRequest)
+
+    def run(self):
+        self.start()
+        cpuStart = standins.cpuclock()
+        wallStart = standins.wallclock()
+        self.reactor.advance(self.args.duration)
+        self.cpu = standins.cpuclock() - cpuStart
+        self.wall = standins.wallclock() - wallStart
+        if self.args.keep_config:
+            print("app config dir: " + self.configDir)
+        else:
+            shutil.rmtree(self.configDir, ignore_errors=True)
+
+    def report(self):
+        duration = float(self.args.duration)
+        ms = lambda v: v * 1000.0
+        print("buttons: {}, included: {}, virtual duration: {:.0f} s, wall: {:.2f} s, cpu: {:.2f} s".format(
+            self.args.buttons, self.stats["buttons_included"], duration, self.wall, self.cpu))
+        print("rx frames: {} ({:.1f}/s virtual, {:.0f}/s of cpu), lost: {}".format(
+            self.stats["rx_frames"], self.stats["rx_frames"] / duration, self.stats["rx_frames"] / max(self.cpu, 1e-9), self.stats["rx_frames_lost"]))
+        print("rx by function: " + ", ".join("{:#04x}: {}".format(f, n) for f, n in sorted(self.rxFunctions.items())))
+        print("tx frames: {}, bytes: {}, beacons: {}, lost: {}, out of range: {}".format(
+            self.stats["tx_frames"], self.stats["tx_bytes"], self.stats["tx_beacons"], self.stats["tx_frames_lost"], self.stats["tx_frames_out_of_range"]))
+        print("uplink sends: {}, messages: {}".format(self.stats["uplink_sends"],
+            json.dumps(dict((k[7:], v) for k, v in self.stats.items() if k.startswith("uplink_") and k != "uplink_sends"), sort_keys=True)))
+        for name, values in (("press to uplink", self.pressToUplink), ("press to ack", self.pressToAck)):
+            print("{}: n {}, p50 {:.0f} ms, p90 {:.0f} ms, p99 {:.0f} ms".format(
+                name, len(values), ms(percentile(values, 50)), ms(percentile(values, 90)), ms(percentile(values, 99))))
+        if self.args.push_fraction:
+            print("push to config: n {}, p50 {:.0f} s, p90 {:.0f} s, p99 {:.0f} s, undelivered {}".format(len(self.pushToConfig),
+                percentile(self.pushToConfig, 50), percentile(self.pushToConfig, 90), percentile(self.pushToConfig, 99), len(self.pushTime)))
+        if self.args.bulk_at:
+            total = self.bulkProgress[-1][2] if self.bulkProgress else 0
+            reached = []
+            for fraction in (0.5, 0.9, 1.0):
+                times = [t for t, done, nodes in self.bulkProgress if done >= fraction * nodes]
+                reached.append("{:.0f}%: {}".format(fraction * 100, "{:.0f} s".format(times[0]) if times else "not reached"))
+            print("bulk push: nodes {}, progress messages {}, done {}, ".format(total, len(self.bulkProgress),
+                self.bulkProgress[-1][1] if self.bulkProgress else 0) + ", ".join(reached))
+        print("queue depth: mean {:.1f}, max {}".format(sum(self.queueDepth) / float(max(len(self.queueDepth), 1)), max(self.queueDepth or [0])))
+        print("tick: n {}, mean {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms".format(len(self.tickTimes),
+            ms(sum(self.tickTimes) / max(len(self.tickTimes), 1)), ms(percentile(self.tickTimes, 99)), ms(max(self.tickTimes or [0]))))
+        stalls = self.reactor.stalls
+        print("reactor stalls: n {}, p99 {:.3f} ms, max {:.3f} ms, over {:.0f} ms: {}".format(len(stalls),
+            ms(percentile(stalls, 99)), ms(max(stalls or [0])), ms(STALL), sum(1 for s in stalls if s > STALL)))
+        lags = self.reactor.lags
+        print("reactor lag: p99 {:.3f} ms, max {:.3f} ms".format(ms(percentile(lags, 99)), ms(max(lags or [0]))))
+        workers = getattr(self.app, "workers", None)
+        if workers is not None:
+            print("worker jobs: {}, busy {:.1f} ms".format(workers.jobs, ms(workers.busy)))
+        for name in sorted(self.handlerCalls):
+            print("{:<16} calls {:>8}, total {:>8.1f} ms, mean {:.3f} ms".format(name, self.handlerCalls[name],
+                ms(self.handlerTimes[name]), ms(self.handlerTimes[name] / self.handlerCalls[name])))
+        print("button resends: {}, frames missed while asleep: {}, app warnings: {}".format(
+            self.stats["button_resends"], self.stats["frames_missed_asleep"], self.app.warnings))
+        for msg in self.app.managerMessages:
+            if msg.get("status") == "profile":
+                self.reportProfile(msg["profile"])
+        if self.args.metrics:
+            metrics = getattr(self.app, "metrics", None)
+            if metrics:
+                print(json.dumps(metrics.report(self.reactor.seconds(), self.app.queues(), self.app.uplink.counters, 10), indent=4, sort_keys=True))
+
+    def reportProfile(self, profile):
+        print("profile: {:.1f} s of wall time".format(profile["duration"]))
+        for name, h in sorted(profile["handlers"].items(), key=lambda item: -item[1]["total"]):
+            print("  {:<16} calls {:>8}, total {:>8.1f} ms, mean {:.3f} ms, p90 {:.3f} ms, max {:.3f} ms".format(name, h["count"],
+                h["total"], h["mean"], h["p90"], h["max"]))
+        if "samples" in profile:
+            print("  stack samples: {}".format(profile["samples"]["count"]))
+            for f in profile["samples"]["functions"][:8]:
+                print("  {:>6}  {}".format(f["count"], f["frame"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test spur_app_a with simulated buttons")
+    parser.add_argument("--buttons", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=3600, help="virtual seconds to run")
+    parser.add_argument("--ramp", type=float, default=1800, help="seconds over which buttons ask to be included")
+    parser.add_argument("--press-interval", type=float, default=600, help="mean seconds between presses of a button")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that a radio frame is lost")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--push-fraction", type=float, default=0.0, help="fraction of buttons whose config the cloud keeps changing")
+    parser.add_argument("--push-interval", type=float, default=1800, help="mean seconds between config changes for those buttons")
+    parser.add_argument("--app-config", default="{}", help="JSON written to the app's local config file")
+    parser.add_argument("--adaptors", type=int, default=1, help="radio adaptors, buttons are spread evenly over them")
+    parser.add_argument("--bulk-at", type=float, default=0, help="seconds after which the cloud sends a new screen to every included button in one bulk message")
+    parser.add_argument("--profile-at", type=float, default=0, help="seconds after which the app is asked to profile itself")
+    parser.add_argument("--profile-duration", type=float, default=600, help="virtual seconds to profile for")
+    parser.add_argument("--profile-sample", type=float, default=0, help="seconds between stack samples, 0 for none")
+    parser.add_argument("--roam", type=float, default=0.0, help="probability that a button moves to another adaptor when it wakes")
+    parser.add_argument("--keep-config", action="store_true", help="keep the app's config dir, with its saved state and any trace")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--metrics", action="store_true", help="print the app's own metrics at the end")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    harness = Harness(args)
+    harness.run()
+    harness.report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# replay.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Replays a trace recorded by spur_app_a (local config "trace": true) against the app,
+with the same stand-ins as the load test. Radio frames and client messages the app
+received are fed back at their recorded times on the virtual clock. What the app
+sends is counted and compared with what it sent when the trace was recorded.
+Records are timed from the start of the app's frame clock, as recorded in the trace, so
+frames fall in the same slots as they did when recorded. Only sends made up to the time of
+the last record, give or take END_SLACK, are compared; those after it are counted separately.
+Traces do not hold the app's state, so pass the .savestate saved when the trace started
+with --state (its journals beside it are copied too); without it, frames from nodes
+included before then are warned about and dropped.
+If the trace spans restarts of the app, only the records since the last one are replayed.
+The replay is open loop: recorded frames are fed back whatever the app sends, so it only
+reproduces the recording while the app behaves as it did. Run with a change that alters what
+is sent, or when, and recorded acks no longer match the app's frames and are warned about.
+Usage: python benchmarks/replay.py CB_CONFIG_DIR/AID1.trace --state AID1.savestate --speed 10
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import base64
+import shutil
+import argparse
+import tempfile
+import collections
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+import standins
+import spur_trace
+import spur_codec
+from loadtest import percentile
+
+APP_ID      = "AID1"
+LEAD        = 10            # Seconds from start-up to the start of the frame clock, which starts 10 s after the adaptors
+DRAIN       = 60            # Seconds run after the last record
+STEP        = 1             # Virtual seconds run between checks on the wall clock
+END_SLACK   = 0.05          # Seconds after the last record that sends are still compared, as its frame may be sent a little later
+
+def frameFunction(frame):
+    if len(frame) == spur_codec.BEACON_HEADER.size:
+        return "beacon"
+    return spur_codec.FUNCTION_NAMES.get(ord(frame[4]), "undefined")
+
+def clientFunction(message):
+    return message.get("function") or message.get("status") or "other"
+
+class Replay(object):
+    def __init__(self, args):
+        self.args = args
+        self.verbose = args.verbose
+        self.recorded = collections.defaultdict(collections.Counter)    # Kind to function to count, from the trace
+        self.replayed = collections.defaultdict(collections.Counter)    # The same, as the app sends them now
+        self.late = collections.Counter()       # Kind to sends made after the time of the last record
+        self.end = None                         # Virtual time of the last record, with END_SLACK
+        self.configDir = tempfile.mkdtemp(prefix="spur_replay_")
+        with open(os.path.join(self.configDir, "spur_app.config"), "w") as f:
+            f.write(args.app_config)
+        if args.state:
+            for suffix in ("", ".journal", ".journal.old"):
+                if os.path.isfile(args.state + suffix):
+                    shutil.copy(args.state + suffix, os.path.join(self.configDir, APP_ID + ".savestate" + suffix))
+        self.reactor = standins.install(self, self.configDir, threads=False)
+
+    # Stand-in callbacks
+    def onAppMessage(self, msg, destination):
+        if msg.get("request") == "command":
+            self.sent(spur_trace.RADIO_TX, frameFunction(base64.b64decode(msg["data"])))
+
+    def onUplink(self, msg):
+        self.sent(spur_trace.CLIENT_TX, clientFunction(msg))
+
+    def sent(self, kind, function):
+        if self.end is not None and self.reactor.seconds() > self.end:
+            self.late[kind] += 1
+        else:
+            self.replayed[kind][function] += 1
+
+    def load(self):
+        self.records = []
+        self.epoch = None
+        for record in spur_trace.readTrace(spur_trace.tracePaths(self.args.trace)):
+            if record[1] != spur_trace.FRAME_CLOCK:
+                self.records.append(record)
+            elif record[0] != self.epoch:
+                if self.epoch is not None:
+                    print("app restarted, {} records before it are not replayed".format(len(self.records)))
+                    self.records = []
+                self.epoch = record[0]
+        if not self.records:
+            raise SystemExit("No records in " + self.args.trace)
+        self.adaptors = []
+        for t, kind, source, data in self.records:
+            if kind in (spur_trace.RADIO_RX, spur_trace.RADIO_TX) and source not in self.adaptors:
+                self.adaptors.append(source)
+            if kind in (spur_trace.RADIO_RX, spur_trace.RADIO_TX):
+                self.recorded[kind][frameFunction(data)] += 1
+            else:
+                self.recorded[kind][clientFunction(json.loads(data))] += 1
+
+    def start(self):
+        import spur_app_a
+        self.app = spur_app_a.App(["spur_app", APP_ID])
+        self.app.onConfigureMessage({})
+        for adaptor in self.adaptors:
+            self.app.onAdaptorService({"id": adaptor, "service": [{"characteristic": "spur"}]})
+        base = self.timeBase()
+        self.end = self.reactor.seconds() + LEAD + self.records[-1][0] - base + END_SLACK
+        for t, kind, source, data in self.records:
+            delay = LEAD + t - base
+            if kind == spur_trace.RADIO_RX:
+                self.reactor.callLater(delay, self.app.onAdaptorData, {"id": source, "characteristic": "spur", "data": base64.b64encode(data)})
+                self.replayed[kind][frameFunction(data)] += 1
+            elif kind == spur_trace.CLIENT_RX:
+                self.reactor.callLater(delay, self.app.client.receive, json.loads(data))
+                self.replayed[kind][clientFunction(json.loads(data))] += 1
+        self.duration = LEAD + self.records[-1][0] - base + DRAIN
+
+    def timeBase(self):
+        """
+        Recorded time that is replayed LEAD seconds after start-up, when the frame clock starts.
+        Traces without the start of the frame clock can only be replayed approximately: the first
+        recorded frame sent by the app is put on a frame slot boundary, which misses any lag it had.
+        """
+        if self.epoch is not None:
+            return self.epoch
+        print("no frame clock record in the trace, replay timing is approximate")
+        first = self.records[0][0]
+        for t, kind, source, data in self.records:
+            if kind == spur_trace.RADIO_TX:
+                return t - math.ceil(t - first)
+        return first
+
+    def run(self):
+        """ Runs as fast as possible, or with --speed, no faster than that many times real time. """
+        self.start()
+        cpuStart = standins.cpuclock()
+        wallStart = standins.wallclock()
+        run = 0
+        while run < self.duration:
+            self.reactor.advance(STEP)
+            run += STEP
+            if self.args.speed:
+                ahead = run / self.args.speed - (standins.wallclock() - wallStart)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.cpu = standins.cpuclock() - cpuStart
+        self.wall = standins.wallclock() - wallStart
+        shutil.rmtree(self.configDir, ignore_errors=True)
+
+    def report(self):
+        ms = lambda v: v * 1000.0
+        print("records: {}, adaptors: {}, traced duration: {:.0f} s, wall: {:.2f} s, cpu: {:.2f} s".format(
+            len(self.records), len(self.adaptors), self.records[-1][0] - self.records[0][0], self.wall, self.cpu))
+        for kind in sorted(spur_trace.KIND_NAMES):
+            functions = sorted(set(self.recorded[kind]) | set(self.replayed[kind]))
+            print("{:<10} recorded {:>7}, replayed {:>7}  ".format(spur_trace.KIND_NAMES[kind],
+                sum(self.recorded[kind].values()), sum(self.replayed[kind].values())) +
+                ", ".join("{}: {}/{}".format(f, self.recorded[kind][f], self.replayed[kind][f]) for f in functions))
+        print("sent after the last record: " + ", ".join("{}: {}".format(spur_trace.KIND_NAMES[kind], self.late[kind]) for kind in (spur_trace.RADIO_TX, spur_trace.CLIENT_TX)))
+        stalls = self.reactor.stalls
+        print("reactor stalls: n {}, p99 {:.3f} ms, max {:.3f} ms".format(len(stalls), ms(percentile(stalls, 99)), ms(max(stalls or [0]))))
+        print("app warnings: {}".format(self.app.warnings))
+        if self.args.metrics:
+            print(json.dumps(self.app.metrics.report(self.reactor.seconds(), self.app.queues(), self.app.uplink.counters, 10), indent=4, sort_keys=True))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a spur_app_a trace against the app")
+    parser.add_argument("trace", help="path of the current trace file, rotated files beside it are read first")
+    parser.add_argument("--state", help=".savestate file to start the app from")
+    parser.add_argument("--speed", type=float, default=0, help="most times real time to run at, 0 for as fast as possible")
+    parser.add_argument("--app-config", default="{}", help="JSON written to the app's local config file")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--metrics", action="store_true", help="print the app's own metrics at the end")
+    args = parser.parse_args()
+    replay = Replay(args)
+    replay.load()
+    replay.run()
+    replay.report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# standins.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Local stand-ins for cbcommslib, cbconfig and the Twisted reactor, so that
+spur_app_a can be driven on a plain machine with no bridge or radio.
+install() must be called before spur_app_a is imported.
+The reactor runs on a virtual clock, and time.time and the frame clock's
+monotonic are pointed at it so the app's timestamps follow the same clock. wallclock keeps the real time.time,
+and the profiler's timer is pointed at it, as handler times are only seen in real time.
+Each callback moves the clock on by the real time it took, so a slow callback
+makes later ones late, as it would on a real reactor. The stand-in thread pool
+runs jobs on real threads, which contend with the reactor thread for the
+interpreter lock as they would on the bridge. While jobs are out and nothing is
+due, the reactor waits for one to finish and the clock moves on by the real time
+waited. Calls that fall due during that wait run late, so a job that runs past a
+due call overstates the reactor's lag. With threads off, jobs run at once on the
+reactor thread instead, so runs are repeatable, as a replay needs.
+"""
+
+import os
+import sys
+import time
+import heapq
+import types
+import itertools
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+wallclock = time.time
+cpuclock = getattr(time, "process_time", None) or time.clock
+
+class DelayedCall(object):
+    def __init__(self, reactor, when, f, args, kw):
+        self.reactor = reactor
+        self.time = when
+        self.f = f
+        self.args = args
+        self.kw = kw
+        self.cancelled = False
+        self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        self.cancelled = True
+
+class Failure(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getErrorMessage(self):
+        return str(self.value)
+
+class Deferred(object):
+    def __init__(self):
+        self.callbacks = []
+        self.result = None
+        self.called = False
+
+    def addCallbacks(self, callback, errback=None, callbackArgs=(), errbackArgs=()):
+        self.callbacks.append(((callback, callbackArgs), (errback, errbackArgs)))
+        if self.called:
+            self.run()
+        return self
+
+    def addCallback(self, callback, *args):
+        return self.addCallbacks(callback, None, args)
+
+    def addErrback(self, errback, *args):
+        return self.addCallbacks(None, errback, (), args)
+
+    def callback(self, result):
+        self.called = True
+        self.result = result
+        self.run()
+
+    def errback(self, failure):
+        self.callback(failure)
+
+    def run(self):
+        while self.callbacks:
+            (cb, cbArgs), (eb, ebArgs) = self.callbacks.pop(0)
+            f, args = (eb, ebArgs) if isinstance(self.result, Failure) else (cb, cbArgs)
+            if f is None:
+                continue
+            try:
+                self.result = f(self.result, *args)
+            except Exception as ex:
+                self.result = Failure(ex)
+
+class AlreadyQuit(Exception):
+    """ Raised by a second ThreadPool.stop(), as by Twisted's. """
+
+class ThreadPool(object):
+    inline = False                  # Run jobs on the reactor thread, set by install()
+
+    def __init__(self, minthreads=0, maxthreads=1, name=None):
+        self.maxthreads = maxthreads
+        self.name = name
+        self.started = False
+        self.joined = False
+        self.jobs = 0
+        self.busy = 0.0             # Real seconds spent running jobs
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.started = True
+        for i in range(0 if self.inline else self.maxthreads):
+            thread = threading.Thread(target=self.work, name=str(self.name) + "-" + str(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self.run(*job)
+
+    def run(self, reactor, f, args, kw, d):
+        start = wallclock()
+        try:
+            result = f(*args, **kw)
+        except Exception as ex:
+            result = Failure(ex)
+        with self.lock:
+            self.jobs += 1
+            self.busy += wallclock() - start
+        if isinstance(result, Failure):
+            reactor.callFromThread(d.errback, result)
+        else:
+            reactor.callFromThread(d.callback, result)
+
+    def stop(self):
+        """ Waits for the jobs already handed over. """
+        if self.joined:
+            raise AlreadyQuit()
+        self.joined = True
+        self.started = False
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+def deferToThreadPool(reactor, pool, f, *args, **kw):
+    """ Runs f on one of pool's threads and fires the result from the reactor. """
+    d = Deferred()
+    reactor.jobStarted()
+    if pool.inline:
+        pool.run(reactor, f, args, kw, d)
+    else:
+        pool.queue.put((reactor, f, args, kw, d))
+    return d
+
+class VirtualReactor(object):
+    def __init__(self, start=1.0e9):
+        self.now = start
+        self.calls = []
+        self.sequence = itertools.count()
+        self.triggers = []
+        self.stalls = []            # Real seconds each callback held the reactor
+        self.lags = []              # Seconds each call ran after it was due
+        self.fromThreads = queue.Queue()
+        self.outstanding = 0        # Thread pool jobs whose result has not reached the reactor
+
+    def addSystemEventTrigger(self, phase, event, f, *args, **kw):
+        self.triggers.append((phase, event, f, args, kw))
+
+    def seconds(self):
+        return self.now
+
+    def callLater(self, delay, f, *args, **kw):
+        call = DelayedCall(self, self.now + max(delay, 0), f, args, kw)
+        heapq.heappush(self.calls, (call.time, next(self.sequence), call))
+        return call
+
+    def jobStarted(self):
+        self.outstanding += 1
+
+    def callFromThread(self, f, *args, **kw):
+        """ Used by thread pool threads to hand back a job's result. """
+        self.fromThreads.put((f, args, kw))
+
+    def takeFromThreads(self, wait=False):
+        """ Schedules results handed back by threads. If wait is set, blocks until there is one. """
+        try:
+            while True:
+                f, args, kw = self.fromThreads.get(wait)
+                wait = False
+                self.outstanding -= 1
+                self.callLater(0, f, *args, **kw)
+        except queue.Empty:
+            pass
+
+    def advance(self, seconds):
+        """ Runs every call due in the next seconds of virtual time, in order. """
+        end = self.now + seconds
+        while True:
+            self.takeFromThreads()
+            due = self.calls[0][0] if self.calls else end
+            if self.outstanding and due > self.now and self.now < end:
+                start = wallclock()
+                self.takeFromThreads(True)        # Without a timeout, which Python 2 polls for
+                self.now += wallclock() - start
+                continue
+            if not self.calls or self.calls[0][0] > end:
+                break
+            when, sequence, call = heapq.heappop(self.calls)
+            if call.cancelled:
+                continue
+            self.lags.append(max(self.now - when, 0))
+            self.now = max(self.now, when)
+            call.called = True
+            start = wallclock()
+            call.f(*call.args, **call.kw)
+            held = wallclock() - start
+            self.stalls.append(held)
+            self.now += held
+        self.now = max(self.now, end)
+
+class CbApp(object):
+    """ Records manager messages and hands radio messages to the harness. """
+    harness = None
+
+    def __init__(self, argv):
+        self.id = argv[1] if len(argv) > 1 else "AID0"
+        self.managerMessages = []
+        self.warnings = 0
+
+    def cbLog(self, level, message):
+        if level in ("warning", "error", "critical"):
+            self.warnings += 1
+            if CbApp.harness and CbApp.harness.verbose:
+                sys.stderr.write(level + ": " + message + "\n")
+
+    def sendMessage(self, msg, destination):
+        CbApp.harness.onAppMessage(msg, destination)
+
+    def sendManagerMessage(self, msg):
+        self.managerMessages.append(msg)
+
+class CbClient(object):
+    """ Hands uplink messages to the harness's cloud. """
+    def __init__(self, aid, cid, keepalive):
+        self.aid = aid
+        self.cid = cid
+
+    def send(self, msg):
+        CbApp.harness.onUplink(msg)
+
+    def receive(self, message):
+        self.onClientMessage(message)
+
+def install(harness, configDir, threads=True):
+    """ Puts the stand-in modules in sys.modules and returns the virtual reactor. """
+    reactor = VirtualReactor()
+    ThreadPool.inline = not threads
+    time.time = reactor.seconds
+    import spur_clock
+    spur_clock.monotonic = reactor.seconds
+    import spur_profile
+    spur_profile.timer = wallclock
+    CbApp.harness = harness
+
+    cbcommslib = types.ModuleType("cbcommslib")
+    cbcommslib.CbApp = CbApp
+    cbcommslib.CbClient = CbClient
+    cbconfig = types.ModuleType("cbconfig")
+    cbconfig.os = os
+    cbconfig.CB_CONFIG_DIR = configDir.rstrip("/") + "/"
+    cbconfig.configFile = os.path.join(configDir, "spur_app.config")
+    cbconfig.__all__ = ["os", "CB_CONFIG_DIR", "configFile"]
+
+    twisted = types.ModuleType("twisted")
+    internet = types.ModuleType("twisted.internet")
+    internet.reactor = reactor
+    twisted.internet = internet
+    threads = types.ModuleType("twisted.internet.threads")
+    threads.deferToThreadPool = deferToThreadPool
+    internet.threads = threads
+    python = types.ModuleType("twisted.python")
+    threadpool = types.ModuleType("twisted.python.threadpool")
+    threadpool.ThreadPool = ThreadPool
+    python.threadpool = threadpool
+    twisted.python = python
+
+    sys.modules.update({
+        "cbcommslib": cbcommslib,
+        "cbconfig": cbconfig,
+        "twisted": twisted,
+        "twisted.internet": internet,
+        "twisted.internet.reactor": reactor,
+        "twisted.internet.threads": threads,
+        "twisted.python": python,
+        "twisted.python.threadpool": threadpool
+    })
+    return reactor
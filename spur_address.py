@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# spur_address.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Allocation of 16-bit radio addresses to nodes.
+Addresses given up by removed nodes are held in quarantine, so that a node still
+asleep with its old address cannot be confused with a new one, and are then
+reused, oldest first, before any address that has never been used.
+Released addresses are kept in release order, so both allocating and releasing are O(1)
+and the state kept is bounded by the number of addresses ever in use at once.
+"""
+
+import collections
+
+MAX_ADDRESS = 0xFFFF
+
+class AddressesExhausted(Exception):
+    pass
+
+class AddressAllocator(object):
+    def __init__(self, reserved, quarantine, maxAddr=0, released=None):
+        """
+        reserved is a list of (first, last) address ranges that are never allocated.
+        quarantine is how long in seconds a released address is held before it is reused.
+        maxAddr and released are as returned by state(): the highest address ever allocated,
+        and [address, time released] pairs, oldest first.
+        """
+        self.reserved = sorted(reserved)
+        self.quarantine = quarantine
+        self.maxAddr = maxAddr
+        self.released = collections.deque((a, t) for a, t in (released or []) if not self.isReserved(a))
+
+    def __len__(self):
+        """ Number of released addresses waiting to be reused. """
+        return len(self.released)
+
+    def isReserved(self, addr):
+        for first, last in self.reserved:
+            if first <= addr <= last:
+                return True
+        return False
+
+    def allocate(self, now):
+        if self.released and self.released[0][1] + self.quarantine <= now:
+            return self.released.popleft()[0]
+        addr = self.maxAddr + 1
+        for first, last in self.reserved:
+            if first <= addr <= last:
+                addr = last + 1
+        if addr > MAX_ADDRESS:
+            raise AddressesExhausted("No address free, " + str(len(self.released)) + " in quarantine")
+        self.maxAddr = addr
+        return addr
+
+    def release(self, addr, now):
+        if not self.isReserved(addr):
+            self.released.append((addr, now))
+
+    def state(self):
+        return self.maxAddr, [[a, t] for a, t in self.released]
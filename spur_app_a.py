@@ -9,26 +9,27 @@ reload(sys)
 sys.setdefaultencoding('utf-8')
 import time
 import json
-import pickle
-import struct
 import base64
+import collections
 from cbcommslib import CbApp, CbClient
 from cbconfig import *
-from twisted.internet import reactor
-
-FUNCTIONS = {
-    "include_req": 0x00,
-    "s_include_req": 0x01,
-    "include_grant": 0x02,
-    "reinclude": 0x04,
-    "config": 0x05,
-    "send_battery": 0x06,
-    "alert": 0x09,
-    "woken_up": 0x07,
-    "ack": 0x08,
-    "beacon": 0x0A,
-    "start": 0x0B
-}
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+import spur_codec
+import spur_clock
+import spur_trace
+from spur_display import RenderCache, configDigest
+from spur_log import SubsystemLog, RADIO_RX, RADIO_TX, QUEUE, CONFIG, CLIENT
+from spur_state import StateJournal, writeAtomic
+from spur_uplink import Uplink
+from spur_metrics import Metrics
+from spur_address import AddressAllocator, AddressesExhausted
+from spur_nodes import NodeTable
+from spur_radio import Radio
+from spur_wakeup import WakeupPolicy
+from spur_dedup import DuplicateFilter
+from spur_profile import Profiler, trimmed
+
 ALERTS = {
     0x0000: "left_short",
     0x0001: "right_short",
@@ -43,42 +44,93 @@ MESSAGE_NAMES = (
     "override"
 )
 
-Y_STARTS = (
-    (38, 0, 0 ,0, 0),
-    (18, 56, 0, 0, 0),
-    (10, 40, 70, 0, 0),
-    (4, 26, 48, 70, 0),
-    (0, 20, 40, 60, 80)
-);
-
 SPUR_ADDRESS = int(os.getenv('CB_SPUR_ADDRESS', '0x0000'), 16)
 CHECK_INTERVAL      = 30*60
 CID                 = "CID157"           # Client ID Client Server
 #CID                 = "CID249"           # Client ID Dev Server
 GRANT_ADDRESS       = 0xBB00
+RESERVED_ADDRESSES  = [                 # Never granted to a node: unassigned, grant and beacon block, broadcast, the bridge
+                        (0x0000, 0x0000),
+                        (0xBB00, 0xBBFF),
+                        (0xFFFF, 0xFFFF),
+                        (SPUR_ADDRESS, SPUR_ADDRESS)
+]
+ADDRESS_QUARANTINE  = 24*60*60          # How long the address of a removed node is held before it is reused, seconds
 NORMAL_WAKEUP       = 60*60*2                # How long node should sleep for, seconds/2
 #NORMAL_WAKEUP       = 30                # How long node should sleep for in normal state, seconds/2
 PRESSED_WAKEUP      = 5*60              # How long node should sleep for in pressed state, seconds/2
-BEACON_INTERVAL     = 6
+BEACON_INTERVAL     = 6                 # Data frame slots between beacon slots
+FRAME_PERIOD        = 1                 # Length of a frame slot, seconds
+FRAME_LATE          = 0.05              # A slot whose frame is sent later than this after its start counts as late, seconds
+FRAME_BUDGET        = 120               # Most bytes sent in a frame, unless a single message is longer
+FRAME_SCAN          = 32                # Most waiting nodes looked at per priority class in a frame
+RENDER_CACHE_SIZE   = 256               # Rendered config payloads kept, shared between nodes
+WORKER_THREADS      = 2                 # Threads that render config and write snapshots, off the reactor
+JOURNAL_BATCH       = 32                # State changes written to the journal together
+JOURNAL_FLUSH_INTERVAL = 10             # Longest time a state change waits to be written, seconds
+JOURNAL_COMPACT_RECORDS = 1000          # Journal length at which it is folded into a new snapshot
+RETRY_POLICY        = {                 # Per function: seconds to wait for an ack, retries before giving up
+                        "include_grant": {"timeout": 9, "retries": 3},
+                        "config": {"timeout": 9, "retries": 3},
+                        "start": {"timeout": 9, "retries": 3},
+                        "send_battery": {"timeout": 9, "retries": 3}
+}
+DEFAULT_RETRY       = {"timeout": 9, "retries": 3}
+UPLINK_FLUSH_INTERVAL = 2               # Longest time battery and woken_up messages are held, seconds
+UPLINK_BUFFER       = 512               # Most low-priority messages held for the client
+DEDUP_WINDOW        = 5                 # Seconds within which a repeated alert or woken_up frame is taken as a resend, just over the buttons' resend interval
+DEDUP_FUNCTIONS     = ("alert", "woken_up")
+METRICS_INTERVAL    = 5*60              # How often metrics are sent to the manager, seconds
+METRICS_NODES       = 20                # Busiest nodes listed in metrics sent to the manager
+CONFIG_CONCURRENCY  = 4                 # Nodes per radio adaptor that are sent config at once
+CONFIG_WAIT_WAKEUP  = 30                # Sleep of a node whose config waits for one of those places, seconds/2
+CONFIG_PUSHES       = 16                # Bulk config pushes whose progress is followed, the oldest is dropped with its waiting nodes failed
+TRACE_FILE_BYTES    = 4*1024*1024       # Size at which a trace file is rotated
+TRACE_FILES         = 4                 # Trace files kept, the current one included
+PROFILE_HANDLERS    = ("onRadioMessage", "onClientMessage", "sendQueued", "sendConfig", "configRendered", "setWakeup", "save", "beacon")
+PROFILE_DURATION    = 60                # Default length of a profile, seconds
+PROFILE_MAX_DURATION = 15*60            # Longest profile allowed, seconds
+PROFILE_TOP         = 20                # Most sampled functions and stacks sent to the manager, the file has them all
 config              = {
-                        "nodes": [ ]
+                        "nodes": [ ],
+                        "log_level": os.getenv('CB_LOGGING_LEVEL', 'INFO'),
+                        "log_levels": { },  # Per subsystem: radio_rx, radio_tx, queue, config, client
+                        "retry": { },       # Overrides of RETRY_POLICY entries
+                        "uplink_batch": True,   # Send the messages held each UPLINK_FLUSH_INTERVAL as one "batch" message. The client must unpack batch
+                        "metrics_file": False,  # Also write metrics, with every node listed, to <id>.stats
+                        "adaptive_wakeup": False,   # Choose sleep intervals from each node's activity, otherwise NORMAL_WAKEUP. Wakes nodes as often as every 15 min
+                        "wakeup_report": False, # Tell the client when each node is next expected to wake. The client must understand next_wakeup
+                        "compact_display": False,   # Leave repeated positions and empty text out of screens. Needs node firmware that keeps X and Y between commands (see spur_display). bytes_saveable in the stats shows what it would save
+                        "trace": False,     # Record radio frames and client messages to <id>.trace, for benchmarks/replay.py
+                        "express_ack": True # Send the ack to an alert at once when the current frame has room, not in the next frame
 }
 
 class App(CbApp):
     def __init__(self, argv):
         self.appClass       = "control"
         self.state          = "stopped"
-        self.id2addr        = {}          # Node id to node address mapping
-        self.addr2id        = {}          # Node address to node if mapping
-        self.maxAddr        = 0
+        self.nodes          = NodeTable()
+        self.addresses      = AddressAllocator(RESERVED_ADDRESSES, ADDRESS_QUARANTINE)
         self.radioOn        = True
-        self.messageQueue   = []
-        self.sentTo         = []
-        self.nodeConfig     = {} 
-        self.beaconCalled   = 0
-        self.including      = []
-        self.sendingConfig  = []
-        self.buttonState    = {}
+        self.radios         = collections.OrderedDict()   # Adaptor id to Radio
+        self.defaultRadio   = Radio(None) # Serves nodes not yet heard on any adaptor
+        self.beaconStarted  = False
+        self.renderCache    = RenderCache(RENDER_CACHE_SIZE)
+        self.workers        = ThreadPool(0, WORKER_THREADS, "spur")
+        self.saving         = False       # A snapshot is being written by a worker
+        self.writingStats   = False       # The stats file is being written by a worker
+        self.frameClock     = None        # Started with the beacon loop
+        self.trace          = None
+        self.pushes         = collections.OrderedDict()   # Bulk config push id to its progress
+        self.profiler       = None        # Set while a profile is being taken
+        try:
+            self.log        = SubsystemLog(self.cbLog, config["log_level"])
+        except KeyError:
+            self.log        = SubsystemLog(self.cbLog)  # Bad CB_LOGGING_LEVEL: info, readLocalConfig warns
+        self.retryPolicy    = dict(RETRY_POLICY)
+        self.metrics        = Metrics(FRAME_BUDGET, time.time())
+        self.wakeupPolicy   = WakeupPolicy(PRESSED_WAKEUP, NORMAL_WAKEUP)
+        self.duplicates     = DuplicateFilter(DEDUP_WINDOW)
 
         # Super-class init must be called
         CbApp.__init__(self, argv)
@@ -90,43 +142,133 @@ class App(CbApp):
                "state": self.state}
         self.sendManagerMessage(msg)
 
-    def save(self):
-        state = {
-            "id2addr": self.id2addr,
-            "addr2id": self.addr2id,
-            "maxAddr": self.maxAddr,
-            "buttonState": self.buttonState
-        }
+    def save(self, background=False):
+        """
+        Writes a snapshot of the whole state and starts a new journal.
+        With background set, the state is pickled and written by a worker thread.
+        """
+        if self.saving:
+            return
+        state = self.nodes.state()
+        state["maxAddr"], state["released"] = self.addresses.state()
+        self.cbLog("debug", "saving state, nodes: " + str(len(state["id2addr"])))
         try:
-            with open(self.saveFile, 'w') as f:
-                pickle.dump(state, f)
-                #self.cbLog("debug", "saving state: " + str(json.dumps(state, indent=4)))
-                self.cbLog("debug", "saving state: " + str(state))
+            self.journal.rotate()
+            if not background:
+                self.journal.writeSnapshot(state)
+                return
         except Exception as ex:
             self.cbLog("warning", "Problem saving state. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+            return
+        self.saving = True
+        self.metrics.workStarted()
+        d = threads.deferToThreadPool(reactor, self.workers, self.journal.writeSnapshot, state)
+        d.addCallbacks(self.onSaved, self.onSaveFailed)
+
+    def onSaved(self, result):
+        self.saving = False
+        self.metrics.workDone()
+
+    def onSaveFailed(self, failure):
+        self.saving = False
+        self.metrics.workDone()
+        ex = failure.value
+        self.cbLog("warning", "Problem saving state. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+
+    def journalRecord(self, record, sync=False):
+        try:
+            self.journal.append(record, sync)
+        except Exception as ex:
+            self.cbLog("warning", "Problem writing state journal. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+
+    def flushState(self):
+        try:
+            self.journal.flush()
+        except Exception as ex:
+            self.cbLog("warning", "Problem writing state journal. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+        if self.trace:
+            self.trace.flush()
+        if self.journal.records > JOURNAL_COMPACT_RECORDS:
+            self.save(background=True)
+        reactor.callLater(JOURNAL_FLUSH_INTERVAL, self.flushState)
 
     def loadSaved(self):
         try:
-            if os.path.isfile(self.saveFile):
-                with open(self.saveFile, 'r') as f:
-                    state = pickle.load(f)
-                self.cbLog("debug", "Loaded saved state: " + str(json.dumps(state, indent=4)))
-                self.id2addr = state["id2addr"]
-                self.addr2id = state["addr2id"]
-                self.maxAddr = state["maxAddr"]
-                self.buttonState = state["buttonState"]
+            state = self.journal.load()
+            self.cbLog("debug", "Loaded saved state: " + str(json.dumps(state, indent=4)) + ", journal records: " + str(self.journal.records))
+            self.nodes.load(state)
+            self.addresses = AddressAllocator(RESERVED_ADDRESSES, ADDRESS_QUARANTINE, state["maxAddr"], state["released"])
         except Exception as ex:
             self.cbLog("warning", "Problem loading saved state. Exception. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
-        #finally:
-        #    try:
-        #        os.remove(self.saveFile)
-        #        self.cbLog("debug", "deleted saved state file")
-        #    except Exception as ex:
-        #        self.cbLog("debug", "Cannot remove saved state file. Exception. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+
+    def reportMetrics(self):
+        now = time.time()
+        msg = {"id": self.id,
+               "status": "metrics",
+               "metrics": self.metrics.report(now, self.queues(), self.uplink.counters, METRICS_NODES)
+              }
+        self.sendManagerMessage(msg)
+        if config["metrics_file"] and not self.writingStats:
+            stats = self.metrics.report(now, self.queues(), self.uplink.counters)
+            self.writingStats = True
+            self.metrics.workStarted()
+            d = threads.deferToThreadPool(reactor, self.workers, self.writeStats, stats)
+            d.addCallbacks(self.onStatsWritten, self.onStatsFailed)
+        reactor.callLater(METRICS_INTERVAL, self.reportMetrics)
+
+    def writeStats(self, stats):
+        """ Runs on a worker thread, as the file is synced to disk. stats is not shared with the reactor thread. """
+        writeAtomic(self.statsFile, json.dumps(stats, indent=4))
+
+    def onStatsWritten(self, result):
+        self.writingStats = False
+        self.metrics.workDone()
+
+    def onStatsFailed(self, failure):
+        self.writingStats = False
+        self.metrics.workDone()
+        ex = failure.value
+        self.cbLog("warning", "Problem writing stats file. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+
+    def queues(self):
+        return dict((radio.adaptor, radio.queue) for radio in self.radios.values())
+
+    def radioFor(self, nodeAddr):
+        """ Returns the Radio serving the node at nodeAddr. """
+        node = self.nodes.get(nodeAddr)
+        if node is not None and node.adaptor in self.radios:
+            return self.radios[node.adaptor]
+        return self.defaultRadio
+
+    def rehome(self, node, adaptor):
+        """ Moves the node, and any messages waiting for it, to the adaptor it has just been heard on. """
+        if adaptor not in self.radios:
+            return
+        old = self.radioFor(node.addr) if node.addr is not None else None
+        node.adaptor = adaptor
+        new = self.radios[adaptor]
+        if old is not None and old is not new:
+            self.log.debug(QUEUE, "rehome: node {} moved from {} to {}", node.nodeID, old.adaptor, adaptor)
+            new.queue.adopt(node.addr, *old.queue.takeDestination(node.addr))
+            if node.addr in old.configuring:
+                old.configuring.discard(node.addr)
+                new.configuring.add(node.addr)
 
     def onStop(self):
+        if self.trace:
+            self.trace.stop()
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler = None
+        self.stopWorkers()
+        self.saving = False
         self.save()
 
+    def stopWorkers(self):
+        """ Waits for a snapshot being written. Called on stop and before reactor shutdown, whichever comes first. """
+        if self.workers.started:
+            self.workers.stop()     # Twisted raises AlreadyQuit if the pool is stopped twice
+
     def reportRSSI(self, rssi):
         msg = {"id": self.id,
                "status": "user_message",
@@ -145,377 +287,557 @@ class App(CbApp):
     def onClientMessage(self, message):
         if True:
         #try:
-            self.cbLog("debug", "onClientMessage, message: " + str(json.dumps(message, indent=4)))
+            self.log.debug(CLIENT, "onClientMessage, message: {}", lambda: json.dumps(message, indent=4))
             if "function" in message:
                 if message["function"] == "include_grant":
                     nodeID = int(message["node"])
-                    if nodeID not in self.id2addr:
-                        self.maxAddr += 1
-                        self.id2addr[nodeID] = self.maxAddr
-                        self.cbLog("debug", "id2addr: " + str(self.id2addr))
-                        self.addr2id[self.maxAddr] = nodeID
-                        self.cbLog("debug", "addr2id: " + str(self.addr2id))
-                        self.buttonState[self.maxAddr] = 0xFF
-                        self.save()
-                    data = struct.pack(">IH", nodeID, self.id2addr[nodeID])
+                    node = self.nodes.byID.get(nodeID)
+                    if node is None or node.addr is None:
+                        try:
+                            addr = self.addresses.allocate(time.time())
+                        except AddressesExhausted as ex:
+                            self.cbLog("warning", "Cannot grant node " + str(nodeID) + ". Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+                            return
+                        node = self.nodes.assign(nodeID, addr)
+                        self.log.debug(CLIENT, "Granted node {} address {}, nodes: {}", nodeID, addr, len(self.nodes))
+                        self.journalRecord(["grant", nodeID, addr], sync=True)
+                    data = spur_codec.GRANT.pack(nodeID, node.addr)
                     msg = self.formatRadioMessage(GRANT_ADDRESS, "include_grant", 0, data)  # Wakeup = 0 after include_grant (stay awake 10s)
-                    self.queueRadio(msg, self.id2addr[nodeID], "include_grant")
+                    self.queueRadio(msg, node.addr, "include_grant")
+                elif message["function"] == "profile":
+                    self.startProfile(message)
+                elif message["function"] == "config" and "nodes" in message:
+                    self.bulkConfig(message)
                 elif message["function"] == "config":
-                    self.cbLog("debug", "onClientMessage, id2addr: " + str(self.id2addr))
-                    self.cbLog("debug", "onClientMessage, addr2id: " + str(self.addr2id))
-                    self.cbLog("debug", "onClientMessage, message[node]: " + str(message["node"]))
+                    self.log.debug(CLIENT, "onClientMessage, message[node]: {}", message["node"])
                     #self.cbLog("debug", "onClientMessage, message[config]: " + str(json.dumps(message["config"], indent=4)))
-                    self.nodeConfig[self.id2addr[int(message["node"])]] = message["config"]
-                    self.cbLog("debug", "onClentMessage, nodeConfig: " + str(json.dumps(self.nodeConfig, indent=4)))
+                    node = self.nodes.byID.get(int(message["node"]))
+                    if node is None or node.addr is None:
+                        self.cbLog("warning", "onClientMessage, config for node without an address: " + str(message["node"]))
+                        return
+                    self.setConfig(node, message["config"], time.time())
         #except Exception as ex:
         #    self.cbLog("warning", "onClientMessage exception. Exception. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
 
+    def setConfig(self, node, nodeConfig, now, digests=None):
+        """ Makes the items of nodeConfig that the node has not acked its pending config. Returns them. """
+        self.supersede(node.addr)
+        changed = self.changedConfig(node, nodeConfig, digests)
+        if changed:
+            self.wakeupPolicy.pushed(node, now)
+        if changed or node.including:
+            node.config = changed
+        else:
+            node.config = None
+            self.log.debug(CLIENT, "setConfig, config for {} already delivered", node.nodeID)
+        self.log.debug(CLIENT, "setConfig, config for {}: {}", node.addr, lambda: json.dumps(node.config, indent=4))
+        return changed
+
+    def changedConfig(self, node, nodeConfig, digests=None):
+        """
+        Returns the items of nodeConfig that the node has not already acked.
+        digests, if given, has the digest of some or all of the items. If every item has changed, nodeConfig itself is
+        returned, so nodes sent the same config share it.
+        """
+        delivered = node.delivered or {}
+        changed = {}
+        for m, value in nodeConfig.items():
+            digest = digests.get(m) if digests else None
+            if digest is None:
+                digest = configDigest(m, value)
+            if delivered.get(m) != digest:
+                changed[m] = value
+        self.log.debug(CONFIG, "changedConfig, node: {}, items: {}, changed: {}", node.addr, len(nodeConfig), len(changed))
+        if len(changed) == len(nodeConfig):
+            return nodeConfig
+        return changed
+
+    def checkConfig(self, nodeConfig):
+        """ Returns (items, digests) for the items of nodeConfig that can be rendered. Warms the render cache for them. """
+        items = {}
+        digests = {}
+        for m, value in nodeConfig.items():
+            try:
+                digest, payload, saving = self.renderCache.renderWithDigest(m, value)
+            except Exception as ex:
+                self.cbLog("warning", "checkConfig, cannot render " + m + ". Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+                continue
+            if payload is None:
+                self.cbLog("warning", "checkConfig, unknown config item: " + m)
+                continue
+            items[m] = value
+            digests[m] = digest
+        return items, digests
+
+    def bulkConfig(self, message):
+        """
+        One config for many nodes: {"function": "config", "nodes": [node ids], "config": {items},
+        "overrides": {node id: {items}}, "id": push id}. overrides and id are optional.
+        The shared items are checked and digested once, and each node's overrides on their own. Nodes without overrides whose
+        items have all changed share one dict as their pending config.
+        If the push has an id, its progress is sent to the client as config_progress messages.
+        A node listed more than once is pushed to once. If a node id is not a number, nothing is pushed and
+        a config_error message is sent to the client instead.
+        """
+        nodeIDs = collections.OrderedDict()
+        for nodeID in message["nodes"]:
+            try:
+                nodeID = int(nodeID)
+            except (TypeError, ValueError) as ex:
+                self.cbLog("warning", "bulkConfig, bad node id: " + repr(nodeID) + ". Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+                self.uplink.immediate({"function": "config_error", "id": message.get("id"), "error": "bad node id", "node": nodeID})
+                return
+            nodeIDs[nodeID] = True
+        items, digests = self.checkConfig(message["config"])
+        overrides = message.get("overrides", {})
+        now = time.time()
+        push = {"id": message.get("id"), "total": 0, "done": 0, "superseded": 0, "failed": 0, "unknown": 0, "waiting": {}}
+        for nodeID in nodeIDs:
+            node = self.nodes.byID.get(nodeID)
+            if node is None or node.addr is None:
+                push["unknown"] += 1
+                continue
+            push["total"] += 1
+            override = overrides.get(str(nodeID))
+            if override:
+                overrideItems, overrideDigests = self.checkConfig(override)
+                nodeConfig = dict(items, **overrideItems)
+                nodeDigests = dict(digests, **overrideDigests)
+            else:
+                nodeConfig = items
+                nodeDigests = digests
+            if self.setConfig(node, nodeConfig, now, nodeDigests):
+                push["waiting"][node.addr] = nodeDigests
+            else:
+                push["done"] += 1
+        self.log.debug(CLIENT, "bulkConfig, push {}: {} nodes, {} already done, {} unknown", push["id"], push["total"], push["done"], push["unknown"])
+        if push["unknown"]:
+            self.cbLog("warning", "bulkConfig, config for " + str(push["unknown"]) + " nodes without an address")
+        if push["id"] is not None:
+            self.pushes.pop(push["id"], None)
+            if len(self.pushes) >= CONFIG_PUSHES:
+                pushID, oldest = self.pushes.popitem(last=False)
+                oldest["failed"] += len(oldest["waiting"])   # No longer followed, so reported as failed
+                oldest["waiting"] = {}
+                self.configProgress(oldest)
+            self.pushes[push["id"]] = push
+            self.configProgress(push)
+
+    def configProgress(self, push):
+        msg = {
+            "function": "config_progress",
+            "id": push["id"],
+            "total": push["total"],
+            "done": push["done"],
+            "superseded": push["superseded"],
+            "failed": push["failed"],
+            "unknown": push["unknown"]
+        }
+        if push["waiting"]:
+            self.uplink.queue(msg, push["id"])     # Held briefly, so a burst of acks gives one message
+        else:
+            self.uplink.discard("config_progress", push["id"])    # So it cannot arrive after this one
+            self.uplink.immediate(msg)
+            self.pushes.pop(push["id"], None)
+
+    def configAcked(self, node):
+        """ Counts the node as done in any push whose items it has now all acked. """
+        for push in list(self.pushes.values()):
+            digests = push["waiting"].get(node.addr)
+            if digests is not None and all(node.delivered.get(m) == d for m, d in digests.items()):
+                del push["waiting"][node.addr]
+                push["done"] += 1
+                self.configProgress(push)
+
+    def supersede(self, nodeAddr, outcome="superseded"):
+        """ Stops following the node in earlier pushes, as it has been given new config, failed or been removed. """
+        for push in list(self.pushes.values()):
+            if push["waiting"].pop(nodeAddr, None) is not None:
+                push[outcome] += 1
+                self.configProgress(push)
+
+    def configPlace(self, nodeAddr):
+        """
+        Returns True if the node may be sent its config now. Config is sent to at most
+        CONFIG_CONCURRENCY nodes per adaptor at once, so a push to many nodes or many nodes
+        being included together do not flood the radio.
+        A node keeps its place until its config messages have been acked or given up on.
+        """
+        radio = self.radioFor(nodeAddr)
+        if nodeAddr in radio.configuring:
+            return True
+        if len(radio.configuring) >= CONFIG_CONCURRENCY:
+            for addr in list(radio.configuring):
+                node = self.nodes.get(addr)
+                if node is None or not (node.sendingConfig or radio.queue.hasPending(addr)):
+                    radio.configuring.discard(addr)
+            if len(radio.configuring) >= CONFIG_CONCURRENCY:
+                return False
+        radio.configuring.add(nodeAddr)
+        return True
+
+    def forgetDelivered(self, node):
+        if node.delivered is not None:
+            node.delivered = None
+            self.journalRecord(["forget", node.addr])
+
     def sendConfig(self, nodeAddr):
         #self.cbLog("debug", "sendConfig, nodeAddr: " + str(nodeAddr) + ", nodeConfig: " + str(json.dumps(self.nodeConfig, indent=4)))
         #self.cbLog("debug", "sendConfig, type of nodeAddr: " + type(nodeAddr).__name__)
+        node = self.nodes.get(nodeAddr)
+        if node is None or node.config is None:
+            self.log.debug(CONFIG, "sendConfig, node {} removed or nothing to send", nodeAddr)  # Node was removed after sendConfig was scheduled
+            if node is not None:
+                node.sendingConfig = False
+            return
+        items = node.config
+        self.metrics.workStarted()
+        d = threads.deferToThreadPool(reactor, self.workers, self.renderConfig, items)
+        d.addCallbacks(self.configRendered, self.renderFailed, callbackArgs=(node, nodeAddr, items), errbackArgs=(node, nodeAddr))
+
+    def renderConfig(self, items):
+        """
+        Runs on a worker thread, so only touches the render cache.
+        Returns (item, digest, payload, saving) for each item, with the exception in place of the payload if it could not be rendered.
+        """
+        rendered = []
+        for m, value in items.items():
+            try:
+                digest, payload, saving = self.renderCache.renderWithDigest(m, value)
+            except Exception as ex:
+                digest, payload, saving = None, ex, 0
+            rendered.append((m, digest, payload, saving))
+        return rendered
+
+    def renderFailed(self, failure, node, nodeAddr):
+        self.metrics.workDone()
+        node.sendingConfig = False  # Config is kept and tried again when the node next wakes
+        ex = failure.value
+        self.cbLog("warning", "sendConfig, render failed for " + str(nodeAddr) + ". Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+
+    def configRendered(self, rendered, node, nodeAddr, items):
+        self.metrics.workDone()
+        if self.nodes.get(nodeAddr) is not node:
+            self.log.debug(CONFIG, "configRendered, node {} removed while rendering", nodeAddr)
+            return
         formatMessage = ""
-        messageCount = 0
-        for m in self.nodeConfig[nodeAddr]:
-            messageCount += 1
-            self.cbLog("debug", "in m loop, m: " + m)
-            aMessage = False
-            if m[0] == "D":
-                formatMessage = struct.pack("cBcBcB", "S", int(m[1:]), "R", 0, "F", 2)
-                aMessage = True
-            elif m == "name":
-                line = "Spur button"
-                stringLength = len(line) + 1
-                formatString = "cBcBcBcBcB" + str(stringLength) + "sc"
-                formatMessage = struct.pack(formatString, "S", 22, "R", 0, "F", 2, "Y", 10, "C", stringLength, str(line), "\00")
-                line = self.nodeConfig[nodeAddr][m] 
-                self.cbLog("debug", "name: " + line)
-                stringLength = len(line) + 1
-                formatString = "cBcB" + str(stringLength) + "sc"
-                segment = struct.pack(formatString, "Y", 40, "C", stringLength, str(line), "\00")
-                formatMessage += segment
-                line = "Double-push to start"
-                stringLength = len(line) + 1
-                formatString = "cBcB" + str(stringLength) + "sc"
-                segment = struct.pack(formatString, "Y", 70, "C", stringLength, str(line), "\00")
-                formatMessage += segment
-            elif m[0] == "S":
-                s = self.nodeConfig[nodeAddr][m]
-                self.cbLog("debug", "nodeConfig before changing: " + str(json.dumps(s, indent=4)))
-                for f in ("SingleLeft", "SingleRight", "DoubleLeft", "DoubleRight", "messageValue", "messageState", "waitValue", "waitState"):
-                    if f not in s:
-                        s[f] = 0xFF
-                #self.cbLog("debug", "nodeConfig before sending: " + str(json.dumps(self.nodeConfig[nodeAddr][m], indent=4)))
-                self.cbLog("debug", "nodeConfig before sending: " + str(json.dumps(s, indent=4)))
-                formatMessage = struct.pack("cBBBBBBBBBBBBBBBB", "M", s["state"], s["state"], s["alert"], s["DoubleLeft"], \
-                    s["SingleLeft"], 0xFF, 0xFF, s["SingleRight"], s["DoubleRight"], s["messageValue"], s["messageState"], \
-                    s["waitValue"], s["waitState"], 0xFF, 0xFF, 0xFF)
-            elif m == "app_value":
-                formatMessage = struct.pack("cB", "A", self.nodeConfig[nodeAddr][m])
-            if aMessage:
-                self.cbLog("debug", "sendConfig, aMessage")
-                display = base64.b64decode(self.nodeConfig[nodeAddr][m])
-                self.cbLog("debug", "sendConfig, display: {}".format(display))
-                lines = display.split("\n")
-                firstSplit = None 
-                numLines = len(lines)
-                for l in lines:
-                    if "|" in l:
-                       self.cbLog("debug", "Line contains |")
-                       if firstSplit is None:
-                           firstSplit = lines.index(l)
-                       splitLine = l.split("|")
-                       for s in (0, 1):
-                           splitLine[s] = splitLine[s].lstrip().rstrip()  # Removes whitespace
-                           self.cbLog("debug", "After whitespace removed: " + str(splitLine[s]))
-                           stringLength = len(splitLine[s]) + 1
-                           y_start =  Y_STARTS[numLines-1][lines.index(l)]
-                           self.cbLog("debug", "sendConfig, string: " + splitLine[s] + ", length: " + str(stringLength))
-                           self.cbLog("debug", "sendConfig, y_start: " + str(y_start))
-                           formatString = "cBcB" + str(stringLength) + "sc"
-                           if s == 0:
-                               x = "l"
-                           else:
-                               x = "r"
-                           segment = struct.pack(formatString, "Y", y_start, x, stringLength, str(splitLine[s]), "\00")
-                           self.cbLog("debug", "segment: " + str(segment.encode("hex")))
-                           formatMessage += segment
-                    else:
-                        self.cbLog("debug", "sendConfig, line: " + str(l))
-                        stringLength = len(l) + 1
-                        y_start =  Y_STARTS[numLines-1][lines.index(l)]
-                        self.cbLog("debug", "sendConfig, y_start: " + str(y_start))
-                        formatString = "cBcB" + str(stringLength) + "sc"
-                        segment = struct.pack(formatString, "Y", y_start, "C", stringLength, str(l), "\00")
-                        formatMessage += segment
-                self.cbLog("debug", "sendConfig, firstSplit: " + str(firstSplit) + ", numLines: " + str(numLines))
-                if firstSplit == 0:
-                    segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 1, "B", 0x62, 0x5C, "X", 2, "Y", 2, "B", 0x60, 0x5A, \
-                                            "X", 0x65, "Y", 1, "B", 0x62, 0x5C, "X", 0x66, "Y", 2, "B", 0x60, 0x5A)  
-                    formatMessage += segment
-                elif numLines == 4:
-                    if firstSplit == 1:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x18, "B", 0x62, 0x44, "X", 2, "Y", 0x19, "B", 0x60, 0x42, \
-                                            "X", 0x65, "Y", 0x18, "B", 0x62, 0x44, "X", 0x66, "Y", 0x19, "B", 0x60, 0x42)  
-                    elif firstSplit == 2:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x2E, "B", 0x62, 0x30, "X", 2, "Y", 0x2F, "B", 0x60, 0x2E, \
-                                            "X", 0x65, "Y", 0x2E, "B", 0x62, 0x30, "X", 0x66, "Y", 0x2F, "B", 0x60, 0x2E)  
-                    elif firstSplit == 3:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x44, "B", 0x62, 0x18, "X", 2, "Y", 0x45, "B", 0x60, 0x16, \
-                                            "X", 0x65, "Y", 0x44, "B", 0x62, 0x18, "X", 0x66, "Y", 0x45, "B", 0x60, 0x16)  
-                    formatMessage += segment
-                elif numLines == 3:
-                    if firstSplit == 1:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x1E, "B", 0x62, 0x40, "X", 2, "Y", 0x1F, "B", 0x60, 0x3E, \
-                                            "X", 0x65, "Y", 0x1E, "B", 0x62, 0x40, "X", 0x66, "Y", 0x1F, "B", 0x60, 0x3E)  
-                    elif firstSplit == 2:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x44, "B", 0x62, 0x18, "X", 2, "Y", 0x45, "B", 0x60, 0x16, \
-                                            "X", 0x65, "Y", 0x44, "B", 0x62, 0x18, "X", 0x66, "Y", 0x45, "B", 0x60, 0x16)  
-                    formatMessage += segment
-                elif numLines == 2:
-                    if firstSplit == 1:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x30, "B", 0x62, 0x2F, "X", 2, "Y", 0x31, "B", 0x60, 0x2D, \
-                                            "X", 0x65, "Y", 0x30, "B", 0x62, 0x2F, "X", 0x66, "Y", 0x31, "B", 0x60, 0x2D)  
-                    formatMessage += segment
-                segment = struct.pack("cc", "E", "S") 
-                formatMessage += segment
-            self.cbLog("debug", "Sending to node: " + str(formatMessage.encode("hex")))
+        for m, digest, payload, saving in rendered:
+            self.log.debug(CONFIG, "in m loop, m: {}", m)
+            if isinstance(payload, Exception):
+                self.cbLog("warning", "sendConfig, cannot render " + m + ". Type: " + str(type(payload)) + "exception: " +  str(payload.args))
+                continue
+            if payload is None:
+                self.cbLog("warning", "sendConfig, unknown config item: " + m)
+                continue
+            formatMessage = payload
+            self.log.debug(CONFIG, "Sending to node: {}", lambda: formatMessage.encode("hex"))
             wakeup = 0
             msg = self.formatRadioMessage(nodeAddr, "config", wakeup, formatMessage)
-            self.queueRadio(msg, int(nodeAddr), "config")
-        nodeID = self.addr2id[nodeAddr]
-        try:
-            if nodeID in list(self.including):
-                self.cbLog("debug", "Removing nodeID " + str(nodeID) + " from " + str(self.including))
-                msg = self.formatRadioMessage(nodeAddr, "start", PRESSED_WAKEUP, formatMessage)
-                self.queueRadio(msg, nodeAddr, "start")
-                #self.requestBattery(nodeAddr)
-                self.including.remove(nodeID)
-        except Exception as ex:
-            self.cbLog("warning", "sendConfig, expection in removing from self.including. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
-        del(self.nodeConfig[nodeAddr])
-        self.sendingConfig.remove(nodeAddr)
+            self.queueRadio(msg, int(nodeAddr), "config", (m, digest))
+            self.metrics.config(len(formatMessage), saving, self.renderCache.compact)
+        self.log.debug(CONFIG, "sendConfig, render cache hits: {}, misses: {}", self.renderCache.hits, self.renderCache.misses)
+        if node.including:
+            self.log.debug(CONFIG, "nodeID {} no longer including", node.nodeID)
+            msg = self.formatRadioMessage(nodeAddr, "start", PRESSED_WAKEUP, formatMessage)
+            self.queueRadio(msg, nodeAddr, "start")
+            #self.requestBattery(nodeAddr)
+            node.including = False
+        if node.config is items:
+            node.config = None
+            node.sendingConfig = False
+        else:
+            reactor.callLater(0, self.sendConfig, nodeAddr)  # Config changed while rendering
+
+    def ackAlert(self, nodeAddr, received=None):
+        """
+        Acks an alert. The ack is sent at once if the current frame of the node's radio has
+        room for it and nothing has gone to the node in that frame, so a press is acked without
+        waiting for the next frame. Only acks are sent outside sendQueued, and beacon frames may
+        carry acks, so this keeps the frame rules. Otherwise the ack is queued for the next frame.
+        received is the time a press arrived, for the press_ack metrics; battery reports pass None
+        and are not timed.
+        """
+        msg = self.formatRadioMessage(nodeAddr, "ack", self.setWakeup(nodeAddr))
+        radio = self.radioFor(nodeAddr)
+        queue = radio.queue
+        if config["express_ack"] and radio.adaptor is not None and nodeAddr not in radio.frameDestinations \
+                and nodeAddr not in queue.ackCount and radio.frameBytes + msg["length"] <= FRAME_BUDGET:
+            self.sendMessage(msg, radio.adaptor)
+            radio.frameBytes += msg["length"]
+            radio.frameDestinations.add(nodeAddr)
+            if received is not None:
+                self.metrics.alertAcked(time.time() - received, True)
+            self.log.debug(QUEUE, "ackAlert, sent at once to {}, frame bytes: {}", nodeAddr, radio.frameBytes)
+        else:
+            entry = queue.push(msg, nodeAddr, "ack")
+            if received is not None:
+                entry["received"] = received
 
     def requestBattery(self, nodeAddr):
         msg = self.formatRadioMessage(nodeAddr, "send_battery", self.setWakeup(nodeAddr))
         self.queueRadio(msg, nodeAddr, "send_battery")
 
-    def onRadioMessage(self, message):
+    def onRadioMessage(self, message, adaptor=None):
         if self.radioOn:
-            self.cbLog("debug", "onRadioMessage")
+            self.log.debug(RADIO_RX, "onRadioMessage")
             try:
-                destination = struct.unpack(">H", message[0:2])[0]
+                destination, source, function, length, payload = spur_codec.decodeHeader(message)
             except Exception as ex:
                 self.cbLog("warning", "onRadioMessage. Malformed radio message. Type: {}, exception: {}".format(type(ex), ex.args))
+                return
             #self.cbLog("debug", "Rx: destination: " + str("{0:#0{1}X}".format(destination,6)))
             if destination == SPUR_ADDRESS:
-                source, hexFunction, length = struct.unpack(">HBB", message[2:6])
-                try:
-                    function = (key for key,value in FUNCTIONS.items() if value==hexFunction).next()
-                except:
-                    function = "undefined"
-                if (source not in self.addr2id) and source != 0:
+                node = self.nodes.get(source)
+                if node is None and source != 0:
                     self.cbLog("warning", "Radio message for node at unallocated address: " + str(source))
                     return
+                if node is not None and node.adaptor != adaptor:
+                    self.rehome(node, adaptor)
                 #hexMessage = message.encode("hex")
                 #self.cbLog("debug", "hex message after decode: " + str(hexMessage))
-                self.cbLog("debug", "Rx: " + function + " from button: " + str("{0:#0{1}x}".format(source,6)))
+                self.log.debug(RADIO_RX, "Rx: {} from button: {:#06x}", function, source)
+                now = time.time()
+                self.metrics.rx(function, source, now)
+                if function in DEDUP_FUNCTIONS and self.duplicates.isDuplicate(node, message, now):
+                    self.log.debug(RADIO_RX, "Rx: {} from {:#06x} is a resend, acking again", function, source)
+                    self.metrics.duplicate(function)
+                    if function == "alert":
+                        try:
+                            battery = (spur_codec.ALERT_TYPE.unpack_from(payload)[0] & 0xFF00) == 0x200
+                        except Exception:
+                            battery = False
+                        self.ackAlert(source, None if battery else now)
+                    else:
+                        msg = self.formatRadioMessage(source, "ack", self.setWakeup(source))
+                        self.queueRadio(msg, source, "ack")
+                    return
 
                 if function == "include_req":
-                    payload = message[10:14]
-                    hexPayload = payload.encode("hex")
-                    self.cbLog("debug", "Rx: hexPayload: " + str(hexPayload) + ", length: " + str(len(payload)))
-                    nodeID = struct.unpack(">I", payload)[0]
-                    self.cbLog("debug", "Rx, include_req, nodeID: " + str(nodeID))
+                    self.log.debug(RADIO_RX, "Rx: hexPayload: {}, length: {}", lambda: payload[0:4].tobytes().encode("hex"), len(payload))
+                    nodeID = spur_codec.NODE_ID.unpack_from(payload)[0]
+                    self.log.debug(RADIO_RX, "Rx, include_req, nodeID: {}", nodeID)
                     msg = {
                         "function": "include_req",
                         "include_req": nodeID
                     }
-                    self.client.send(msg)
-                    if nodeID not in list(self.including):
-                        self.including.append(nodeID)
+                    self.uplink.immediate(msg)
+                    node = self.nodes.byID.get(nodeID)
+                    if node is not None and node.addr is not None:
+                        self.forgetDelivered(node)  # Node has been reset, so has lost its config
+                    if node is None or not node.including:
+                        node = self.nodes.include(nodeID)
                     else:
-                        self.cbLog("debug", "nodeID " + str(nodeID) + " should be removed from " + str(self.including))
+                        self.log.debug(RADIO_RX, "nodeID {} asked to be included again, removing it", nodeID)
                         self.removeNodeMessages(nodeID)
+                    if node.adaptor != adaptor:
+                        self.rehome(node, adaptor)
                 elif function == "alert":
-                    payload = message[10:12]
-                    #hexPayload = payload.encode("hex")
-                    #self.cbLog("debug", "Rx: hexPayload: " + str(hexPayload) + ", length: " + str(len(payload)))
                     try:
-                        alertType = struct.unpack(">H", payload)[0]
+                        alertType = spur_codec.ALERT_TYPE.unpack_from(payload)[0]
                     except Exception as ex:
                         alertType = 0xFFFF
                         self.cbLog("warning", "Unknown alert type received. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
-                    self.cbLog("debug", "Rx, alert, type: " + str(alertType))
+                    self.log.debug(RADIO_RX, "Rx, alert, type: {}", alertType)
                     if (alertType & 0xFF00) == 0x200:
                         battery_level = ((alertType & 0xFF) * 0.235668)/10
-                        self.cbLog("debug", "Battery level for " + str(self.addr2id[source]) + ": " + str(battery_level))
+                        self.log.debug(RADIO_RX, "Battery level for {}: {}", node.nodeID, battery_level)
+                        self.wakeupPolicy.battery(node, battery_level)
                         msg = {
                             "function": "battery",
                             "value": battery_level,
                             "signal": 5, 
-                            "source": self.addr2id[source]
+                            "source": node.nodeID
                         }
+                        self.uplink.queue(msg, source)
+                        self.ackAlert(source)
                     else:    
-                        self.buttonState[source] = alertType & 0xFF
+                        self.wakeupPolicy.pressed(node, time.time())
+                        if node.buttonState != alertType & 0xFF:
+                            node.buttonState = alertType & 0xFF
+                            self.journalRecord(["button", source, alertType & 0xFF])
                         msg = {
                             "function": "alert",
                             "type": alertType,
                             "signal": 5, 
-                            "source": self.addr2id[source]
+                            "source": node.nodeID
                         }
-                    self.client.send(msg)
-                    msg = self.formatRadioMessage(source, "ack", self.setWakeup(source))
-                    self.queueRadio(msg, source, "ack")
+                        self.uplink.immediate(msg)
+                        self.ackAlert(source, now)
                 elif function == "woken_up":
-                    self.cbLog("debug", "Rx, woken_up")
+                    self.log.debug(RADIO_RX, "Rx, woken_up")
                     msg = self.formatRadioMessage(source, "ack", self.setWakeup(source))
                     self.queueRadio(msg, source, "ack")
                     msg = {
                         "function": "woken_up",
                         "signal": 5, 
-                        "source": self.addr2id[source]
+                        "source": node.nodeID
                     }
-                    self.client.send(msg)
+                    self.uplink.queue(msg, source)
                 elif function == "ack":
                     self.onAck(source)
                 else:
                     self.cbLog("warning", "onRadioMessage, undefined message, source " + str(source) + ", function: " + function)
 
     def setWakeup(self, nodeAddr):
-        self.cbLog("debug", "setWakeup, nodeAddr: " + str(nodeAddr) + ", self.buttonState: " + str(self.buttonState))
-        if self.buttonState[nodeAddr] == 0x01:
+        node = self.nodes.get(nodeAddr)
+        self.log.debug(QUEUE, "setWakeup, nodeAddr: {}, buttonState: {}", nodeAddr, node.buttonState)
+        now = time.time()
+        if node.buttonState == 0x01:
             wakeup = PRESSED_WAKEUP
+        elif config["adaptive_wakeup"]:
+            wakeup = self.wakeupPolicy.interval(node, now)
         else:
             wakeup = NORMAL_WAKEUP
-        self.cbLog("debug", "setWakeup, self.nodeConfig: " + str(json.dumps(self.nodeConfig, indent=4)) + ", self.including: " + str(self.including))
-        if (nodeAddr in self.nodeConfig) or (self.addr2id[nodeAddr] in self.including):
+        self.log.debug(QUEUE, "setWakeup, pending config: {}, including: {}", node.config is not None, node.including)
+        waiting = (node.config is not None) and not node.sendingConfig and not self.configPlace(nodeAddr)
+        if ((node.config is not None) or node.including) and not waiting:
             wakeup = 0;
-            self.cbLog("debug", "wakeup = 0 (1)")
-        else:
-            self.cbLog("debug", "setWakeup, messageQueue (2): " + str(json.dumps(self.messageQueue, indent=4)))
-            for m in self.messageQueue:
-                if m["destination"] == nodeAddr:
-                    wakeup = 0;
-                    self.cbLog("debug", "wakeup = 0 (2)")
-        if (nodeAddr in self.nodeConfig) and (nodeAddr not in self.sendingConfig):
+            self.log.debug(QUEUE, "wakeup = 0 (1)")
+        elif self.radioFor(nodeAddr).queue.hasPending(nodeAddr):
+            wakeup = 0;
+            self.log.debug(QUEUE, "wakeup = 0 (2), queued for node: {}", lambda: self.radioFor(nodeAddr).queue.depth(nodeAddr))
+        elif waiting:
+            wakeup = min(wakeup, CONFIG_WAIT_WAKEUP)
+            self.log.debug(QUEUE, "setWakeup, config for {} waits for a place", nodeAddr)
+        if (node.config is not None) and not node.sendingConfig and not waiting:
             reactor.callLater(1, self.sendConfig, nodeAddr)
-            self.sendingConfig.append(nodeAddr)
+            node.sendingConfig = True
+        self.reportWakeup(node, wakeup, now)
         return wakeup
 
+    def reportWakeup(self, node, wakeup, now):
+        """ Tells the client when a node sent to sleep for wakeup, in seconds/2, is next expected to wake. """
+        if wakeup > 0 and config["wakeup_report"]:
+            msg = {
+                "function": "next_wakeup",
+                "source": node.nodeID,
+                "time": now + 2*wakeup,
+                "interval": 2*wakeup
+            }
+            self.uplink.queue(msg, node.addr)
+
     def onAck(self, source):
         """ If there is no more data to send, we need to send an ack with a normal wakeup 
             time to ensure that the node goes to sleep.
         """
-        self.cbLog("debug", "onAck, source: " + str("{0:#0{1}x}".format(source,6)))
-        #self.cbLog("debug", "onAck, messageQueue: " + str(json.dumps(self.messageQueue, indent=4)))
-        #self.cbLog("debug", "onAck, source: " + str(source) + ", self.sentTo: " + str(self.sentTo))
-        if source in self.sentTo:
-            moreToCome = False
-            for m in list(self.messageQueue):
-                if m["destination"] == source:
-                    if m["attempt"] > 0:
-                        self.cbLog("debug", "onAck, removing message: " + m["function"] + " for: " + str(source))
-                        self.messageQueue.remove(m)
-                        self.sentTo.remove(source)
-                    else:
-                        moreToCome = True
-            if not moreToCome and (self.addr2id[source] not in self.including):
+        self.log.debug(QUEUE, "onAck, source: {:#06x}", source)
+        queue = self.radioFor(source).queue
+        if source in queue.inFlight:
+            node = self.nodes.get(source)
+            m = queue.complete(source)
+            self.log.debug(QUEUE, "onAck, removing message: {} for: {}", m["function"], source)
+            self.metrics.acked(time.time() - m["sentTime"])
+            if m["config"]:
+                item, digest = m["config"]
+                if node.delivered is None:
+                    node.delivered = {}
+                node.delivered[item] = digest
+                self.journalRecord(["delivered", source, item, digest])
+                if self.pushes:
+                    self.configAcked(node)
+            moreToCome = queue.hasUnsent(source)
+            if not moreToCome and not node.including:
                 msg = self.formatRadioMessage(source, "ack", PRESSED_WAKEUP)  # Shorter wakeup immediately after config
                 self.queueRadio(msg, source, "ack")
+                self.reportWakeup(node, PRESSED_WAKEUP, time.time())
         else:
             self.cbLog("warning", "onAck, received ack from node that does not correspond to a sent message: " + str(source))
 
     def beacon(self):
+        """
+        Runs once per frame slot. Every BEACON_INTERVAL + 1'th slot of a radio is a beacon slot.
+        If slots were missed, a beacon that fell in them is sent now and the radio keeps its beacon phase.
+        """
         #self.cbLog("debug", "beacon")
-        if self.beaconCalled == BEACON_INTERVAL:
-            msg = self.formatRadioMessage(0xBBBB, "beacon", 0)
-            self.sendMessage(msg, self.adaptor)
-            self.sendQueued(True)
-            self.beaconCalled = 0
-        else:
-            self.beaconCalled += 1
-            self.sendQueued(False)
-        reactor.callLater(1, self.beacon)
+        tick = self.frameClock.tick(spur_clock.monotonic())
+        if tick is not None:
+            slot, lag, missed = tick
+            self.metrics.slot(lag, missed, lag > FRAME_LATE)
+            if missed:
+                self.log.debug(RADIO_TX, "beacon, slot {} is {:.3f} s late, {} slots missed", slot, lag, missed)
+            for radio in self.radios.values():
+                if radio.nextBeacon is None:
+                    radio.nextBeacon = slot + BEACON_INTERVAL
+                if slot >= radio.nextBeacon:
+                    msg = self.formatRadioMessage(0xBBBB, "beacon", 0)
+                    self.sendMessage(msg, radio.adaptor)
+                    self.metrics.beacon(radio.adaptor)
+                    self.sendQueued(radio, True)
+                    radio.nextBeacon += ((slot - radio.nextBeacon) // (BEACON_INTERVAL + 1) + 1) * (BEACON_INTERVAL + 1)
+                else:
+                    self.sendQueued(radio, False)
+        reactor.callLater(self.frameClock.delay(spur_clock.monotonic()), self.beacon)
 
     def removeNodeMessages(self, nodeID):
         #Remove all queued messages and reference to a node if we get a new include_req
-        if nodeID in self.id2addr:
-            addr = self.id2addr[nodeID]
-            for m in list(self.messageQueue):
-                if m["destination"] == addr:
-                    self.messageQueue.remove(m)
-                    self.cbLog("debug", "removeNodeMessages: " + str(nodeID) + ", removed: " + m["function"])
-            if addr in self.nodeConfig:
-                del self.nodeConfig[addr]
-            if addr in self.buttonState:
-                del self.buttonState[addr]
-            if nodeID in self.id2addr:
-                del self.id2addr[nodeID]
-            if addr in self.addr2id:
-                del self.addr2id[addr]
-
-    def sendQueued(self, beacon):
+        node = self.nodes.byID.get(nodeID)
+        if node is not None and node.addr is not None:
+            addr = node.addr
+            radio = self.radioFor(addr)
+            for m in radio.queue.removeDestination(addr):
+                self.log.debug(QUEUE, "removeNodeMessages: {}, removed: {}", nodeID, m["function"])
+            radio.configuring.discard(addr)
+            self.nodes.unassign(node)
+            self.metrics.forget(addr)
+            self.supersede(addr, "failed")
+            now = time.time()
+            self.addresses.release(addr, now)
+            self.journalRecord(["remove", nodeID, addr, now])
+
+    def sendQueued(self, radio, beacon):
         """
-        In frames where a beacon is sent, don't send anything else apart from acks.
+        Sends one frame of at most FRAME_BUDGET bytes, packed by RadioQueue.packFrame.
+        Retries that have run out are dropped first. Each radio fills its own frame.
         """
+        queue = radio.queue
         now = time.time()
+        due = []
+        if not beacon:
+            for m in queue.popDue(now + FRAME_PERIOD / 2.0):  # Due in this slot, so a slot run a little late does not put retries back one
+                if m["attempt"] > self.retryPolicy.get(m["function"], DEFAULT_RETRY)["retries"]:
+                    queue.complete(m["destination"])
+                    self.metrics.giveUp(m["function"])
+                    if m["config"] and self.pushes:
+                        self.supersede(m["destination"], "failed")
+                    self.log.debug(QUEUE, "sendQueued: No ack, removed: {}, for {}", m["function"], m["destination"])
+                else:
+                    due.append(m)
         sentLength = 0
-        sentAck = []
-        for m in list(self.messageQueue):
-            #self.cbLog("debug", "sendQueued: messageQueue: " + str(m["destination"]) + ", " + m["function"] + ", sentAck: " + str(sentAck))
-            if sentLength < 120:   # Send max of 120 bytes in a frame
-                if m["function"] == "ack":
-                    self.cbLog("debug", "sendQueued: Tx: " + m["function"] + " to " + str(m["destination"]))
-                    self.sendMessage(m["message"], self.adaptor)
-                    self.messageQueue.remove(m)  # Only send ack once
-                    sentAck.append(m["destination"])
-                    sentLength += m["message"]["length"]
-                elif (m["destination"] not in self.sentTo) and (m["destination"] not in sentAck) and not beacon:
-                    self.sendMessage(m["message"], self.adaptor)
-                    self.sentTo.append(m["destination"])
-                    m["sentTime"] = now
-                    m["attempt"] = 1
-                    self.cbLog("debug", "sendQueued: Tx: " + m["function"] + " to " + str(m["destination"]) + ", attempt " + str(m["attempt"]))
-                    sentLength += m["message"]["length"]
-                elif (now - m["sentTime"] > 9) and (m["destination"] not in sentAck) and (m["attempt"] > 0) and not beacon:
-                    if m["attempt"] > 3:
-                        self.messageQueue.remove(m)
-                        self.sentTo.remove(m["destination"])
-                        self.cbLog("debug", "sendQueued: No ack, removed: " + m["function"] + ", for " + str(m["destination"]))
-                    else:
-                        self.sendMessage(m["message"], self.adaptor)
-                        m["sentTime"] = now
-                        m["attempt"] += 1
-                        self.cbLog("debug", "sendQueued: Tx: " + m["function"] + " to " + str(m["destination"]) + ", attempt " + str(m["attempt"]))
-                        sentLength += m["message"]["length"]
-                #self.cbLog("debug", "sendQueued, sentLength: " + str(sentLength))
+        radio.frameDestinations = set()
+        for m in queue.packFrame(FRAME_BUDGET, due, beacon, FRAME_SCAN):
+            if m["function"] == "ack":
+                self.log.debug(QUEUE, "sendQueued: Tx: {} to {}", m["function"], m["destination"])
+                self.sendMessage(m["message"], radio.adaptor)
+                radio.frameDestinations.add(m["destination"])
+                if "received" in m:
+                    self.metrics.alertAcked(now - m["received"], False)
+            else:
+                self.transmit(radio, m, now)
+            sentLength += m["message"]["length"]
+        radio.frameBytes = sentLength
+        if sentLength > 0:
+            self.metrics.frame(sentLength, radio.adaptor)
+            self.log.debug(QUEUE, "sendQueued, frame bytes: {}, utilization: {:.0f}%, average: {:.0f}%", sentLength, \
+                100.0*sentLength/FRAME_BUDGET, lambda: 100.0*self.metrics.utilization())
+
+    def transmit(self, radio, m, now):
+        """ Sends an in-flight message and sets its retry deadline. """
+        self.sendMessage(m["message"], radio.adaptor)
+        radio.frameDestinations.add(m["destination"])
+        m["sentTime"] = now
+        m["attempt"] += 1
+        self.metrics.tx(m["function"], m["attempt"])
+        radio.queue.schedule(m, now + self.retryPolicy.get(m["function"], DEFAULT_RETRY)["timeout"])
+        self.log.debug(QUEUE, "sendQueued: Tx: {} to {}, attempt {}", m["function"], m["destination"], m["attempt"])
 
     def formatRadioMessage(self, destination, function, wakeupInterval, data = None):
         if True:
         #try:
-            timeStamp = 0x00000000
+            m = spur_codec.encode(destination, SPUR_ADDRESS, function, wakeupInterval, data)
             if function != "beacon":
-                length = 4
-            else:
-                length = 10
-            if data:
-                length += len(data)
-                #self.cbLog("debug", "data length: " + str(length))
-            m = ""
-            m += struct.pack(">H", destination)
-            m += struct.pack(">H", SPUR_ADDRESS)
-            if function != "beacon":
-                m+= struct.pack("B", FUNCTIONS[function])
-                m+= struct.pack("B", length)
-                m+= struct.pack("I", timeStamp)
-                m+= struct.pack(">H", wakeupInterval)
-                self.cbLog("debug", "formatRadioMessage, wakeupInterval: " +  str(wakeupInterval))
-            #self.cbLog("debug", "length: " +  str(length))
-            if data:
-                m += data
+                self.log.debug(RADIO_TX, "formatRadioMessage, wakeupInterval: {}", wakeupInterval)
             length = len(m)
-            hexPayload = m.encode("hex")
-            self.cbLog("debug", "Tx: sending: " + str(hexPayload))
+            self.log.debug(RADIO_TX, "Tx: sending: {}", lambda: m.encode("hex"))
             msg= {
                 "id": self.id,
                 "length": length,
@@ -526,15 +848,8 @@ class App(CbApp):
         #except Exception as ex:
         #    self.cbLog("warning", "Problem formatting message. Exception: " + str(type(ex)) + ", " + str(ex.args))
 
-    def queueRadio(self, msg, destination, function):
-        toQueue = {
-            "message": msg,
-            "destination": destination,
-            "function": function,
-            "attempt": 0,
-            "sentTime": 0
-        }
-        self.messageQueue.append(toQueue)
+    def queueRadio(self, msg, destination, function, config=None):
+        self.radioFor(destination).queue.push(msg, destination, function, config)
 
     def onAdaptorService(self, message):
         #self.cbLog("debug", "onAdaptorService, message: " + str(message))
@@ -549,14 +864,80 @@ class App(CbApp):
                                   ]
                       }
                 self.sendMessage(req, message["id"])
-                self.adaptor = message["id"]
+                if message["id"] not in self.radios:
+                    if self.defaultRadio.adaptor is None:
+                        radio = self.defaultRadio   # First adaptor takes over anything queued before it was known
+                        radio.adaptor = message["id"]
+                    else:
+                        radio = Radio(message["id"])
+                    self.radios[message["id"]] = radio
+                    self.cbLog("info", "Radio adaptor " + str(message["id"]) + ", adaptors: " + str(len(self.radios)))
         self.setState("running")
-        reactor.callLater(10, self.beacon)
+        if not self.beaconStarted:
+            self.beaconStarted = True
+            self.frameClock = spur_clock.FrameClock(FRAME_PERIOD, spur_clock.monotonic() + 10)
+            reactor.callLater(10, self.beacon)
+            if self.trace:
+                self.trace.frameClock(time.time() + 10)
 
     def onAdaptorData(self, message):
         #self.cbLog("debug", "onAdaptorData, message: " + str(message))
         if message["characteristic"] == "spur":
-            self.onRadioMessage(base64.b64decode(message["data"]))
+            self.onRadioMessage(base64.b64decode(message["data"]), message["id"])
+
+    def startProfile(self, message):
+        """
+        {"function": "profile", "duration": seconds, "sample": seconds between stack samples, "report": "file", "manager" or "both"}.
+        All but function are optional. Handler times are always taken; the stack is only sampled if sample is given.
+        """
+        if self.profiler:
+            self.cbLog("warning", "startProfile, a profile is already being taken")
+            return
+        try:
+            duration = min(float(message.get("duration", PROFILE_DURATION)), PROFILE_MAX_DURATION)
+            sample = float(message["sample"]) if message.get("sample") else None
+        except Exception as ex:
+            self.cbLog("warning", "startProfile, bad request. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+            return
+        self.profiler = Profiler(self, PROFILE_HANDLERS)
+        self.profiler.start(sample)
+        self.client.onClientMessage = self.onClientMessage     # The client holds the method it was given
+        reactor.callLater(duration, self.stopProfile, message.get("report", "both"))
+        self.cbLog("info", "Profiling for " + str(duration) + " s, stack samples every: " + str(sample))
+
+    def stopProfile(self, destination):
+        if not self.profiler:
+            return
+        report = self.profiler.stop()
+        self.profiler = None
+        self.client.onClientMessage = self.onClientMessage
+        if destination in ("file", "both"):
+            try:
+                writeAtomic(self.profileFile, json.dumps(report, indent=4))
+            except Exception as ex:
+                self.cbLog("warning", "Problem writing profile. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+        if destination in ("manager", "both"):
+            msg = {"id": self.id,
+                   "status": "profile",
+                   "profile": trimmed(report, PROFILE_TOP)
+                  }
+            self.sendManagerMessage(msg)
+        self.cbLog("info", "Profile taken")
+
+    def startTrace(self):
+        """ Records radio frames and client messages, in and out, by wrapping the methods that carry them. """
+        try:
+            self.trace = spur_trace.TraceRecorder(CB_CONFIG_DIR + self.id + ".trace", TRACE_FILE_BYTES, TRACE_FILES, time.time, self.onTraceError)
+        except Exception as ex:
+            self.cbLog("warning", "Problem starting trace. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+            return
+        self.onAdaptorData = self.trace.tap(self.onAdaptorData, spur_trace.RADIO_RX, spur_trace.adaptorData)
+        self.onClientMessage = self.trace.tap(self.onClientMessage, spur_trace.CLIENT_RX, spur_trace.clientMessage)
+        self.sendMessage = self.trace.tap(self.sendMessage, spur_trace.RADIO_TX, spur_trace.radioCommand)
+        self.cbLog("info", "Tracing to " + self.trace.path)
+
+    def onTraceError(self, ex):
+        self.cbLog("warning", "Problem writing trace, tracing stopped. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
 
     def readLocalConfig(self):
         global config
@@ -568,16 +949,35 @@ class App(CbApp):
         except Exception as ex:
             self.cbLog("warning", "Problem reading config. Type: " + str(type(ex)) + ", exception: " +  str(ex.args))
         self.cbLog("debug", "Config: " + str(json.dumps(config, indent=4)))
+        try:
+            self.log.setLevels(config["log_level"], config["log_levels"])
+        except Exception as ex:
+            self.cbLog("warning", "Problem setting log levels. Type: " + str(type(ex)) + ", exception: " +  str(ex.args))
+        for function, policy in config["retry"].items():
+            self.retryPolicy[function] = dict(self.retryPolicy.get(function, DEFAULT_RETRY), **policy)
 
     def onConfigureMessage(self, managerConfig):
         self.readLocalConfig()
+        self.renderCache = RenderCache(RENDER_CACHE_SIZE, config["compact_display"])
+        if config["trace"]:
+            self.startTrace()
         self.client = CbClient(self.id, CID, 3)
         self.client.onClientMessage = self.onClientMessage
         self.client.sendMessage = self.sendMessage
         self.client.cbLog = self.cbLog
+        if self.trace:
+            self.client.send = self.trace.tap(self.client.send, spur_trace.CLIENT_TX, spur_trace.clientMessage)
+        self.uplink = Uplink(self.client.send, reactor.callLater, UPLINK_FLUSH_INTERVAL, UPLINK_BUFFER, config["uplink_batch"])
         self.saveFile = CB_CONFIG_DIR + self.id + ".savestate"
+        self.statsFile = CB_CONFIG_DIR + self.id + ".stats"
+        self.profileFile = CB_CONFIG_DIR + self.id + ".profile"
+        self.journal = StateJournal(self.saveFile, JOURNAL_BATCH)
+        self.workers.start()
+        reactor.addSystemEventTrigger("before", "shutdown", self.stopWorkers)
         self.loadSaved()
+        reactor.callLater(JOURNAL_FLUSH_INTERVAL, self.flushState)
         reactor.callLater(CHECK_INTERVAL, self.checkConnected)
+        reactor.callLater(METRICS_INTERVAL, self.reportMetrics)
         self.setState("starting")
 
 if __name__ == '__main__':
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# spur_clock.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Frame clock for the radio. Time is cut into slots of a fixed period, counted from
+when the clock started, and a frame is sent at the start of each slot. Each slot is
+timed from the start of the clock rather than from the end of the last one, so the
+time spent sending a frame does not push the next one back and beacons keep a steady
+rate. A slot that starts late is still run; slots passed over altogether are skipped
+and counted, rather than sent in a burst to catch up.
+"""
+
+import os
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    def monotonic():
+        """ Seconds since an arbitrary point, not moved by changes to the wall clock. 10ms resolution on Linux. """
+        return os.times()[4]
+
+class FrameClock(object):
+    def __init__(self, period, now):
+        """ period is the slot length in seconds. now, and the times given to tick and delay, are from monotonic(). """
+        self.period = period
+        self.epoch = now
+        self.next = 0       # Next slot to run
+
+    def boundary(self, slot):
+        """ Time at which slot starts. """
+        return self.epoch + slot * self.period
+
+    def tick(self, now):
+        """
+        Called when the next slot is due. Returns (slot, lag, missed): the slot to run, how long
+        after its start it is being run, and how many slots were passed over since the last one.
+        Returns None if called more than half a period early, when there is nothing to run yet.
+        """
+        if now < self.boundary(self.next) - self.period / 2.0:
+            return None
+        slot = max(int((now - self.epoch) / self.period), self.next)
+        missed = slot - self.next
+        self.next = slot + 1
+        return slot, now - self.boundary(slot), missed
+
+    def delay(self, now):
+        """ Seconds until the next slot starts. """
+        return max(self.boundary(self.next) - now, 0)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# spur_codec.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Encoding and decoding of Spur radio frames.
+Frames from the bridge:  destination, source, function, length, timestamp, wakeup, data
+Frames from a button:    destination, source, function, length, timestamp, payload
+Beacons:                 destination, source
+"""
+
+import struct
+
+FUNCTIONS = {
+    "include_req": 0x00,
+    "s_include_req": 0x01,
+    "include_grant": 0x02,
+    "reinclude": 0x04,
+    "config": 0x05,
+    "send_battery": 0x06,
+    "alert": 0x09,
+    "woken_up": 0x07,
+    "ack": 0x08,
+    "beacon": 0x0A,
+    "start": 0x0B
+}
+FUNCTION_NAMES = dict((value, key) for key, value in FUNCTIONS.items())
+
+# The timestamp is always 0, so packing it big-endian gives the same bytes as the native order used originally
+TX_HEADER           = struct.Struct(">HHBBIH")
+BEACON_HEADER       = struct.Struct(">HH")
+RX_HEADER           = struct.Struct(">HHBB")
+RX_PAYLOAD_OFFSET   = 10
+NODE_ID             = struct.Struct(">I")       # include_req payload
+ALERT_TYPE          = struct.Struct(">H")       # alert payload
+GRANT               = struct.Struct(">IH")      # include_grant data: node id, address
+
+def encode(destination, source, function, wakeupInterval, data=None):
+    """ Returns the frame as a string. """
+    if function == "beacon":
+        frame = BEACON_HEADER.pack(destination, source)
+    else:
+        length = 4
+        if data:
+            length += len(data)
+        frame = TX_HEADER.pack(destination, source, FUNCTIONS[function], length, 0, wakeupInterval)
+    if data:
+        frame += data
+    return frame
+
+def decodeHeader(frame):
+    """
+    Returns (destination, source, function, length, payload) for a frame received from a button.
+    payload is a memoryview on frame, so no bytes are copied.
+    function is "undefined" if the function code is not known.
+    Raises struct.error if the frame is too short to hold a header.
+    """
+    view = memoryview(frame)
+    destination, source, hexFunction, length = RX_HEADER.unpack_from(view)
+    return destination, source, FUNCTION_NAMES.get(hexFunction, "undefined"), length, view[RX_PAYLOAD_OFFSET:]
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# spur_dedup.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Detection of frames a button has sent again because it did not hear our ack.
+A copy has the same function, length, timestamp and payload as a frame from the
+same node a short time before. The last few frames of each node are kept on its
+Node record, so memory is bounded by the number of nodes.
+Buttons send a timestamp of 0, so two real presses of the same kind give the same
+frame, and a second press within the window is taken as a resend and only acked.
+The window is kept just over the buttons' resend interval to make that unlikely.
+It runs from the first copy and later copies do not extend it, so a run of
+identical presses is only held back for one window. A resend that comes after
+the window, once acks to two copies have been lost, is passed on as a new frame.
+"""
+
+import collections
+
+KEY_OFFSET = 4          # The key is the frame from the function code on, so it leaves out the addresses
+
+class DuplicateFilter(object):
+    def __init__(self, window, depth=4):
+        """ Frames are compared with the last depth frames from the node that arrived within window seconds. """
+        self.window = window
+        self.depth = depth
+
+    def isDuplicate(self, node, frame, now):
+        """ Frames from a source with no node, which can only ask to be included, are never taken as copies. """
+        if node is None:
+            return False
+        key = frame[KEY_OFFSET:]
+        recent = node.recentFrames
+        if recent is None:
+            recent = node.recentFrames = collections.deque(maxlen=self.depth)
+        for k, t in recent:
+            if k == key and now - t <= self.window:
+                return True
+        recent.append((key, now))
+        return False
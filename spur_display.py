@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# spur_display.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Renders node config items (D* screens, name, S* state tables, app_value) into
+the byte payloads carried by config messages.
+Screens can be rendered compactly, with positions only sent when they change,
+empty text left out and the boxes of an outline put in the order that needs the
+fewest positions. The node firmware is not in this tree, so this rests on the
+command format: X and Y are commands of their own, text commands carry no Y and box
+commands neither X nor Y, so the node draws at the position it was last given. Compact output
+also assumes that drawing text or a box does not move that position, which has
+not been checked on a node, so it is only sent when compact_display is set.
+"""
+
+import json
+import base64
+import struct
+import hashlib
+import threading
+import collections
+
+Y_STARTS = (
+    (38, 0, 0 ,0, 0),
+    (18, 56, 0, 0, 0),
+    (10, 40, 70, 0, 0),
+    (4, 26, 48, 70, 0),
+    (0, 20, 40, 60, 80)
+);
+SCREEN_HEIGHT = 100     # Rows that the lines of screens with more lines than Y_STARTS has are spread over
+
+# (numLines, firstSplit) to (y, height) of the outline drawn around split lines
+BOX_OUTLINES = {
+    (4, 1): (0x18, 0x44),
+    (4, 2): (0x2E, 0x30),
+    (4, 3): (0x44, 0x18),
+    (3, 1): (0x1E, 0x40),
+    (3, 2): (0x44, 0x18),
+    (2, 1): (0x30, 0x2F)
+}
+STATE_FIELDS = ("SingleLeft", "SingleRight", "DoubleLeft", "DoubleRight", "messageValue", "messageState", "waitValue", "waitState")
+
+def configDigest(item, value):
+    """ Digest of a single config item, independent of dict ordering. """
+    return hashlib.sha1(item + "\x00" + json.dumps(value, sort_keys=True)).hexdigest()
+
+def textSegment(y, x, line):
+    stringLength = len(line) + 1
+    return struct.pack("cBcB" + str(stringLength) + "sc", "Y", y, x, stringLength, str(line), "\00")
+
+def lineStarts(numLines):
+    """ Y of each line of a screen with numLines lines. """
+    if numLines <= len(Y_STARTS):
+        return Y_STARTS[numLines-1]
+    spacing = SCREEN_HEIGHT // numLines
+    return tuple(i * spacing for i in range(numLines))
+
+class ScreenEncoder(object):
+    """
+    Builds the commands for one screen. Without compact, every text segment and box
+    sets its own position, byte for byte as screens have always been sent.
+    With compact, a command is only preceded by the positions that differ from the
+    node's, so for a given drawing order no shorter sequence draws the same screen.
+    """
+    def __init__(self, screen, compact=False):
+        self.compact = compact
+        self.x = None           # Position the node will have, None where not known
+        self.y = None
+        self.commands = [struct.pack("cBcBcB", "S", screen, "R", 0, "F", 2)]
+
+    def moveTo(self, x=None, y=None):
+        if x is not None and not (self.compact and x == self.x):
+            self.commands.append(struct.pack("cB", "X", x))
+            self.x = x
+        if y is not None and not (self.compact and y == self.y):
+            self.commands.append(struct.pack("cB", "Y", y))
+            self.y = y
+
+    def text(self, y, align, line):
+        if self.compact and not line:
+            return
+        self.moveTo(y=y)
+        stringLength = len(line) + 1
+        self.commands.append(struct.pack("cB" + str(stringLength) + "sc", align, stringLength, str(line), "\00"))
+
+    def box(self, x, y, width, height):
+        self.moveTo(x, y)
+        self.commands.append(struct.pack("cBB", "B", width, height))
+
+    def boxOutline(self, y, height):
+        """
+        An outer and an inner box around each half of the screen. The halves are
+        columns 1 to 98 and 101 to 198, so they do not overlap. Compact output draws
+        both outer boxes and then both inner ones, which keeps the order within each
+        half and needs Y twice rather than four times.
+        """
+        left = ((1, y, 0x62, height), (2, y + 1, 0x60, height - 2))
+        right = ((0x65, y, 0x62, height), (0x66, y + 1, 0x60, height - 2))
+        boxes = zip(left, right) if self.compact else (left, right)
+        for pair in boxes:
+            for box in pair:
+                self.box(*box)
+
+    def payload(self):
+        return "".join(self.commands) + struct.pack("cc", "E", "S")
+
+def renderScreen(screen, encoded, compact=False):
+    encoder = ScreenEncoder(screen, compact)
+    display = base64.b64decode(encoded)
+    lines = display.split("\n")
+    firstSplit = None
+    numLines = len(lines)
+    starts = lineStarts(numLines)
+    for i, l in enumerate(lines):
+        if "|" in l:
+            if firstSplit is None:
+                firstSplit = i
+            splitLine = l.split("|")
+            encoder.text(starts[i], "l", splitLine[0].strip())
+            encoder.text(starts[i], "r", splitLine[1].strip())
+        else:
+            encoder.text(starts[i], "C", l)
+    if firstSplit == 0:
+        encoder.boxOutline(1, 0x5C)
+    elif (numLines, firstSplit) in BOX_OUTLINES:
+        encoder.boxOutline(*BOX_OUTLINES[(numLines, firstSplit)])
+    return encoder.payload()
+
+def renderName(name):
+    formatMessage = struct.pack("cBcBcB", "S", 22, "R", 0, "F", 2)
+    formatMessage += textSegment(10, "C", "Spur button")
+    formatMessage += textSegment(40, "C", name)
+    formatMessage += textSegment(70, "C", "Double-push to start")
+    return formatMessage
+
+def renderStates(s):
+    f = dict((field, s.get(field, 0xFF)) for field in STATE_FIELDS)
+    return struct.pack("cBBBBBBBBBBBBBBBB", "M", s["state"], s["state"], s["alert"], f["DoubleLeft"], \
+        f["SingleLeft"], 0xFF, 0xFF, f["SingleRight"], f["DoubleRight"], f["messageValue"], f["messageState"], \
+        f["waitValue"], f["waitState"], 0xFF, 0xFF, 0xFF)
+
+def render(item, value, compact=False):
+    """ Returns the config message payload for one config item, or None if the item is not known. """
+    if item[0] == "D":
+        return renderScreen(int(item[1:]), value, compact)
+    elif item == "name":
+        return renderName(value)
+    elif item[0] == "S":
+        return renderStates(value)
+    elif item == "app_value":
+        return struct.pack("cB", "A", value)
+    return None
+
+class RenderCache(object):
+    """
+    Bounded LRU of rendered payloads, keyed by the digest of the config item.
+    Buttons that share a layout share one rendering.
+    Safe to use from worker threads. The lock is only held for the LRU, not while rendering.
+    Each screen is kept with the bytes compact rendering saves over the full one, with
+    compact set, or would save, without it, so the saving can be reported either way.
+    """
+    def __init__(self, maxSize=256, compact=False):
+        self.maxSize = maxSize
+        self.compact = compact
+        self.payloads = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def render(self, item, value):
+        return self.renderWithDigest(item, value)[1]
+
+    def renderWithDigest(self, item, value):
+        """ Returns (digest, payload, saving). payload is None if item is not known. saving is 0 for items other than screens. """
+        digest = configDigest(item, value)
+        with self.lock:
+            entry = self.payloads.pop(digest, None)
+            if entry is not None:
+                self.hits += 1
+                self.payloads[digest] = entry
+                return (digest,) + entry
+            self.misses += 1
+        payload = render(item, value, self.compact)
+        if payload is None:
+            return digest, None, 0
+        saving = 0
+        if item[0] == "D":
+            other = render(item, value, not self.compact)
+            saving = len(other) - len(payload) if self.compact else len(payload) - len(other)
+        with self.lock:
+            if digest not in self.payloads and len(self.payloads) >= self.maxSize:
+                self.payloads.popitem(last=False)
+            self.payloads[digest] = (payload, saving)
+        return digest, payload, saving
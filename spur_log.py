@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# spur_log.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Level-gated logging on top of cbLog, configurable per subsystem.
+Messages are format strings whose arguments are only formatted when the line
+will be emitted. Arguments that are callables, such as a lambda wrapping
+json.dumps, are only called then too.
+"""
+
+RADIO_RX    = "radio_rx"
+RADIO_TX    = "radio_tx"
+QUEUE       = "queue"
+CONFIG      = "config"
+CLIENT      = "client"
+SUBSYSTEMS  = (RADIO_RX, RADIO_TX, QUEUE, CONFIG, CLIENT)
+
+LEVELS = {
+    "debug": 10,
+    "info": 20,
+    "warning": 30,
+    "error": 40,
+    "critical": 50
+}
+
+class SubsystemLog(object):
+    def __init__(self, cbLog, level="info", levels=None):
+        self.cbLog = cbLog
+        self.setLevels(level, levels)
+
+    def setLevels(self, level, levels=None):
+        """
+        level applies to every subsystem not named in levels.
+        Raises KeyError for an unknown level, leaving the levels as they were.
+        """
+        default = LEVELS[level.lower()]
+        thresholds = dict((s, default) for s in SUBSYSTEMS)
+        if levels:
+            for subsystem, l in levels.items():
+                thresholds[subsystem] = LEVELS[l.lower()]
+        self.thresholds = thresholds
+        self.debugEnabled = dict((s, t <= LEVELS["debug"]) for s, t in thresholds.items())
+
+    def enabled(self, subsystem, level):
+        return LEVELS[level] >= self.thresholds[subsystem]
+
+    def log(self, subsystem, level, message, *args):
+        if LEVELS[level] >= self.thresholds[subsystem]:
+            if args:
+                message = message.format(*[a() if callable(a) else a for a in args])
+            self.cbLog(level, message)
+
+    def debug(self, subsystem, message, *args):
+        if self.debugEnabled[subsystem]:
+            if args:
+                message = message.format(*[a() if callable(a) else a for a in args])
+            self.cbLog("debug", message)
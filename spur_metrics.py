@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# spur_metrics.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Counters and histograms kept by the app for export to the manager.
+Everything is cumulative from start-up, so rates come from comparing two reports.
+Recording is a dict increment or a bisect into a short list, cheap enough for every frame.
+"""
+
+import bisect
+
+# Histogram bucket upper bounds. Values above the last bound go in a final overflow bucket.
+ACK_LATENCY_BOUNDS  = (0.5, 1, 2, 3, 5, 8, 13, 21)         # Seconds from the last send of a message to its ack
+FRAME_BYTES_BOUNDS  = (20, 40, 60, 80, 100, 120, 140, 160)  # Bytes in a frame that carried messages
+PRESS_ACK_BOUNDS    = (0.01, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)      # Seconds from an alert being received to its ack being sent
+SLOT_LAG_BOUNDS     = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)    # Seconds from the start of a frame slot to its frame being sent
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ Returns the upper bound of the bucket holding the p'th percentile, or max if it is in the overflow bucket. """
+        if self.count == 0:
+            return 0
+        rank = p * self.count / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": round(float(self.total) / self.count, 3) if self.count else 0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "max": round(self.max, 3),
+            "bounds": list(self.bounds),
+            "buckets": list(self.buckets)
+        }
+
+class Metrics(object):
+    def __init__(self, frameBudget, now):
+        self.frameBudget = frameBudget
+        self.started = now
+        self.rxFrames = {}          # Function to frames received
+        self.txFrames = 0           # Frames that carried messages, beacons not counted
+        self.txBytes = 0
+        self.txMessages = {}        # Function to messages sent, first attempts and retries
+        self.overBudget = 0         # Frames over frameBudget, which only a single longer message makes
+        self.beacons = 0
+        self.adaptors = {}          # Adaptor to [frames, bytes, beacons]
+        self.retries = {}           # Function to sends after the first
+        self.giveUps = {}           # Function to messages dropped after the last retry
+        self.duplicates = {}        # Function to frames received again and not passed on
+        self.frameBytes = Histogram(FRAME_BYTES_BOUNDS)
+        self.ackLatency = Histogram(ACK_LATENCY_BOUNDS)
+        self.lastSeen = {}          # Node address to time of the last frame from it
+        self.configMessages = 0     # Config messages queued, not counting retries
+        self.configBytes = 0        # Their payload bytes
+        self.configSaved = 0        # Payload bytes saved by compact screen rendering
+        self.configSaveable = 0     # Payload bytes compact screen rendering would have saved while it was off
+        self.pressAck = Histogram(PRESS_ACK_BOUNDS)
+        self.expressAcks = 0        # Press acks sent at once rather than in the next frame
+        self.slots = 0              # Frame slots run
+        self.lateSlots = 0          # Of those, slots run later than the app allows
+        self.missedSlots = 0        # Slots passed over because the reactor was held up
+        self.slotLag = Histogram(SLOT_LAG_BOUNDS)
+        self.workerJobs = 0         # Jobs handed to worker threads
+        self.workerPending = 0      # Of those, jobs whose result has not come back
+
+    def rx(self, function, source, now):
+        self.rxFrames[function] = self.rxFrames.get(function, 0) + 1
+        if source != 0:         # Nodes asking to be included send from address 0
+            self.lastSeen[source] = now
+
+    def tx(self, function, attempt):
+        self.txMessages[function] = self.txMessages.get(function, 0) + 1
+        if attempt > 1:
+            self.retries[function] = self.retries.get(function, 0) + 1
+
+    def giveUp(self, function):
+        self.giveUps[function] = self.giveUps.get(function, 0) + 1
+
+    def duplicate(self, function):
+        self.duplicates[function] = self.duplicates.get(function, 0) + 1
+
+    def acked(self, latency):
+        self.ackLatency.add(latency)
+
+    def adaptor(self, adaptor):
+        if adaptor not in self.adaptors:
+            self.adaptors[adaptor] = [0, 0, 0]
+        return self.adaptors[adaptor]
+
+    def beacon(self, adaptor):
+        self.beacons += 1
+        self.adaptor(adaptor)[2] += 1
+
+    def frame(self, length, adaptor):
+        counts = self.adaptor(adaptor)
+        counts[0] += 1
+        counts[1] += length
+        self.txFrames += 1
+        self.txBytes += length
+        self.frameBytes.add(length)
+        if length > self.frameBudget:
+            self.overBudget += 1
+
+    def alertAcked(self, latency, express):
+        self.pressAck.add(latency)
+        if express:
+            self.expressAcks += 1
+
+    def config(self, length, saving, compact):
+        """ saving is the bytes compact rendering saves on the payload, or would save if compact is not set. """
+        self.configMessages += 1
+        self.configBytes += length
+        if compact:
+            self.configSaved += saving
+        else:
+            self.configSaveable += saving
+
+    def slot(self, lag, missed, late):
+        self.slots += 1
+        self.missedSlots += missed
+        if late:
+            self.lateSlots += 1
+        self.slotLag.add(max(lag, 0))
+
+    def workStarted(self):
+        self.workerJobs += 1
+        self.workerPending += 1
+
+    def workDone(self):
+        self.workerPending -= 1
+
+    def utilization(self):
+        """ Mean fraction of frameBudget used by frames that carried messages. """
+        if self.txFrames == 0:
+            return 0
+        return float(self.txBytes) / (self.txFrames * self.frameBudget)
+
+    def forget(self, source):
+        self.lastSeen.pop(source, None)
+
+    def report(self, now, queues, uplinkCounters, maxNodes=None):
+        """
+        Returns the metrics as a JSON-serialisable dict. queues maps adaptor to its RadioQueue.
+        Nodes are listed busiest first, by queue depth and then by how recently they were heard.
+        If maxNodes is set, only that many are listed.
+        """
+        addrs = set(self.lastSeen)
+        for q in queues.values():
+            addrs.update(q.pending)
+            addrs.update(q.inFlight)
+        nodes = []
+        for addr in addrs:
+            seen = self.lastSeen.get(addr)
+            nodes.append({
+                "address": addr,
+                "depth": sum(q.depth(addr) for q in queues.values()),
+                "last_seen": round(now - seen, 1) if seen is not None else None
+            })
+        nodes.sort(key=lambda n: (-n["depth"], n["last_seen"] if n["last_seen"] is not None else float("inf")))
+        if maxNodes is not None:
+            nodes = nodes[:maxNodes]
+        adaptors = {}
+        for adaptor, q in queues.items():
+            frames, sent, beacons = self.adaptors.get(adaptor, (0, 0, 0))
+            adaptors[str(adaptor)] = {
+                "frames": frames,
+                "bytes": sent,
+                "beacons": beacons,
+                "depth": len(q),
+                "acks": len(q.acks),
+                "in_flight": len(q.inFlight),
+                "waiting": len(q.pending)
+            }
+        return {
+            "uptime": round(now - self.started, 1),
+            "rx": dict(self.rxFrames),
+            "tx": {
+                "frames": self.txFrames,
+                "bytes": self.txBytes,
+                "beacons": self.beacons,
+                "messages": dict(self.txMessages),
+                "budget": self.frameBudget,
+                "over_budget": self.overBudget,
+                "utilization": round(self.utilization(), 3),
+                "frame_bytes": self.frameBytes.summary()
+            },
+            "retries": dict(self.retries),
+            "give_ups": dict(self.giveUps),
+            "duplicates": dict(self.duplicates),
+            "ack_latency": self.ackLatency.summary(),
+            "press_ack": self.pressAck.summary(),
+            "express_acks": self.expressAcks,
+            "config": {
+                "messages": self.configMessages,
+                "bytes": self.configBytes,
+                "bytes_saved": self.configSaved,
+                "bytes_saveable": self.configSaveable
+            },
+            "slots": {
+                "run": self.slots,
+                "late": self.lateSlots,
+                "missed": self.missedSlots,
+                "lag": self.slotLag.summary()
+            },
+            "workers": {
+                "jobs": self.workerJobs,
+                "pending": self.workerPending
+            },
+            "adaptors": adaptors,
+            "uplink": dict(uplinkCounters),
+            "nodes": nodes
+        }
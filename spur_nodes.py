@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# spur_nodes.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Table of the nodes known to the app, one record per node, indexed by node id and by address.
+A node that has asked to be included but has not yet been granted an address is
+in the id index only. The saved state keeps the dicts it always has, so the table
+is built from them on load and turned back into them for a snapshot.
+"""
+
+class Node(object):
+    __slots__ = ("nodeID", "addr", "adaptor", "buttonState", "config", "delivered", "including", "sendingConfig",
+                 "lastPress", "lastPush", "pushGap", "battery", "recentFrames")
+
+    def __init__(self, nodeID):
+        self.nodeID = nodeID
+        self.addr = None
+        self.adaptor = None             # Adaptor the node was last heard on, not saved
+        self.buttonState = 0xFF
+        self.config = None              # Config items waiting to be sent, or None
+        self.delivered = None           # Config item to digest of the value the node has acked, or None
+        self.including = False          # Include requested and start not yet queued
+        self.sendingConfig = False      # sendConfig has been scheduled
+        self.clearActivity()
+
+    def clearActivity(self):
+        """ What the wakeup policy has learnt about the node, not saved. """
+        self.lastPress = None
+        self.lastPush = None            # Last time the cloud sent config that had changed
+        self.pushGap = None             # Moving average of the time between such pushes
+        self.battery = None
+        self.recentFrames = None        # Recent frames from the node, for spotting copies
+
+class NodeTable(object):
+    def __init__(self):
+        self.byID = {}
+        self.byAddr = {}
+
+    def __len__(self):
+        """ Number of nodes with an address. """
+        return len(self.byAddr)
+
+    def __iter__(self):
+        return iter(self.byAddr.values())
+
+    def get(self, addr):
+        return self.byAddr.get(addr)
+
+    def include(self, nodeID):
+        """ Marks nodeID as including, adding it to the table if it is not there. """
+        node = self.byID.get(nodeID)
+        if node is None:
+            node = self.byID[nodeID] = Node(nodeID)
+        node.including = True
+        return node
+
+    def assign(self, nodeID, addr):
+        node = self.byID.get(nodeID)
+        if node is None:
+            node = self.byID[nodeID] = Node(nodeID)
+        node.addr = addr
+        node.buttonState = 0xFF
+        self.byAddr[addr] = node
+        return node
+
+    def unassign(self, node):
+        """ Takes the node's address away and clears what it had. The node stays in the table only if it is including. """
+        self.byAddr.pop(node.addr, None)
+        node.addr = None
+        node.buttonState = 0xFF
+        node.config = None
+        node.delivered = None
+        node.sendingConfig = False
+        node.clearActivity()
+        if not node.including:
+            self.byID.pop(node.nodeID, None)
+
+    def load(self, state):
+        self.byID = {}
+        self.byAddr = {}
+        for nodeID, addr in state["id2addr"].items():
+            node = self.assign(nodeID, addr)
+            node.buttonState = state["buttonState"].get(addr, 0xFF)
+            node.delivered = state["delivered"].get(addr)
+
+    def state(self):
+        """ Returns the saved state dicts: id2addr, addr2id, buttonState and delivered. """
+        state = {"id2addr": {}, "addr2id": {}, "buttonState": {}, "delivered": {}}
+        for addr, node in self.byAddr.items():
+            state["id2addr"][node.nodeID] = addr
+            state["addr2id"][addr] = node.nodeID
+            state["buttonState"][addr] = node.buttonState
+            if node.delivered:
+                state["delivered"][addr] = dict(node.delivered)    # Copied, as the state may be pickled on another thread
+        return state
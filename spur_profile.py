@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# spur_profile.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Profiling of the app's handlers for a bounded time, switched on by a client "profile" message.
+While it is off nothing is wrapped, so it costs nothing. While it is on, each named method
+is replaced on the instance by a wrapper that times it, and a thread can sample the stack
+of the reactor thread. stop() puts the methods back and returns the report.
+Handler times are in milliseconds and inclusive, so a handler called from another is counted in both.
+"""
+
+import os
+import sys
+import time
+import threading
+import collections
+from spur_metrics import Histogram
+
+HANDLER_BOUNDS  = (0.1, 0.2, 0.5, 1, 2, 5, 10, 50)  # Milliseconds a handler call took
+STACK_DEPTH     = 8             # Innermost frames kept per sample
+
+timer = time.time
+
+class StackSampler(threading.Thread):
+    """ Records the innermost STACK_DEPTH frames of one thread every interval seconds. """
+    def __init__(self, threadID, interval):
+        threading.Thread.__init__(self, name="spur-profile")
+        self.daemon = True
+        self.threadID = threadID
+        self.interval = interval
+        self.samples = collections.Counter()    # Stack, innermost frame first, to times seen
+        self.count = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.threadID)
+            stack = []
+            while frame is not None and len(stack) < STACK_DEPTH:
+                code = frame.f_code
+                stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(frame.f_lineno) + ")")
+                frame = frame.f_back
+            del frame
+            if stack:
+                self.samples[tuple(stack)] += 1
+                self.count += 1
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+class Profiler(object):
+    def __init__(self, target, names):
+        """ names are the methods of target to time. """
+        self.target = target
+        self.names = names
+        self.handlers = {}          # Name to Histogram of call times
+        self.saved = {}             # Name to what the instance had for it before, None for the class method
+        self.sampler = None
+        self.started = None
+
+    def start(self, sampleInterval=None):
+        """ Must be called on the thread to be sampled. """
+        self.started = timer()
+        for name in self.names:
+            self.saved[name] = self.target.__dict__.get(name)
+            setattr(self.target, name, self.wrap(name, getattr(self.target, name)))
+        if sampleInterval:
+            self.sampler = StackSampler(threading.current_thread().ident, sampleInterval)
+            self.sampler.start()
+
+    def wrap(self, name, f):
+        histogram = self.handlers[name] = Histogram(HANDLER_BOUNDS)
+        clock = timer
+        def timed(*args, **kw):
+            start = clock()
+            try:
+                return f(*args, **kw)
+            finally:
+                histogram.add((clock() - start) * 1000.0)
+        return timed
+
+    def stop(self):
+        """ Puts the methods back and returns the report. """
+        for name, saved in self.saved.items():
+            if saved is None:
+                del self.target.__dict__[name]
+            else:
+                setattr(self.target, name, saved)
+        self.saved = {}
+        report = {
+            "duration": round(timer() - self.started, 1),
+            "handlers": dict((name, dict(h.summary(), total=round(h.total, 3))) for name, h in self.handlers.items())
+        }
+        if self.sampler:
+            self.sampler.stop()
+            functions = collections.Counter()
+            for stack, n in self.sampler.samples.items():
+                functions[stack[0]] += n
+            report["samples"] = {
+                "count": self.sampler.count,
+                "interval": self.sampler.interval,
+                "functions": [{"frame": f, "count": n} for f, n in functions.most_common()],
+                "stacks": [{"stack": list(stack), "count": n} for stack, n in self.sampler.samples.most_common()]
+            }
+        return report
+
+def trimmed(report, top):
+    """ Returns a copy of report with only the top most sampled functions and stacks. """
+    if "samples" not in report:
+        return report
+    samples = dict(report["samples"], functions=report["samples"]["functions"][:top], stacks=report["samples"]["stacks"][:top])
+    return dict(report, samples=samples)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# spur_queue.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+"""
+
+import heapq
+import itertools
+import collections
+
+# Lower numbers are sent first. Acks are always class 0.
+PRIORITIES = {
+    "ack": 0,
+    "include_grant": 1,
+    "start": 1,
+    "config": 2,
+    "send_battery": 3
+}
+LOWEST_PRIORITY = 3
+DATA_PRIORITIES = range(1, LOWEST_PRIORITY + 1)
+
+def priority(function):
+    return PRIORITIES.get(function, LOWEST_PRIORITY)
+
+class RadioQueue(object):
+    """
+    Downlink queue of radio messages, indexed by destination address.
+    Acks are held in their own FIFO and are sent once, never retried.
+    Every other message waits in a FIFO for its destination and at most
+    one message per destination is in flight (sent, waiting for an ack).
+    Destinations that can be sent to are kept in one ring per priority class,
+    by the function of the message at the head of their FIFO. A destination
+    rejoins the back of a ring when its in-flight message completes, so nodes
+    are served round-robin within a class.
+    In-flight messages are kept in a heap ordered by retry deadline. Entries for
+    messages that have since been acked are left in the heap and skipped when
+    they reach the top.
+    packFrame chooses the messages for each frame.
+    """
+    def __init__(self):
+        self.acks           = collections.deque()           # Acks waiting to be sent
+        self.ackCount       = {}                            # Destination to number of queued acks
+        self.pending        = {}                            # Destination to FIFO of messages not yet sent
+        self.inFlight       = {}                            # Destination to message waiting for an ack
+        self.ready          = [collections.OrderedDict() for p in range(LOWEST_PRIORITY + 1)]
+                                                            # Per priority, destinations with pending messages and nothing in flight
+        self.deadlines      = []                            # Heap of (deadline, sequence, entry) for in-flight messages
+        self.sequence       = itertools.count()             # Orders entries with equal deadlines
+        self.held           = None                          # Destination whose message did not fit in the last frame
+        self.acksWaited     = False                         # No ack fitted beside the held message in the last frame
+
+    def __len__(self):
+        return len(self.acks) + len(self.inFlight) + sum(len(q) for q in self.pending.values())
+
+    def push(self, msg, destination, function, config=None):
+        """ config is (item, digest) for a config message, recorded as delivered when it is acked. """
+        entry = {
+            "message": msg,
+            "destination": destination,
+            "function": function,
+            "attempt": 0,
+            "sentTime": 0,
+            "config": config
+        }
+        if function == "ack":
+            self.acks.append(entry)
+            self.ackCount[destination] = self.ackCount.get(destination, 0) + 1
+        else:
+            if destination not in self.pending:
+                self.pending[destination] = collections.deque()
+            self.pending[destination].append(entry)
+            if destination not in self.inFlight and len(self.pending[destination]) == 1:
+                self.ready[priority(function)][destination] = True
+        return entry
+
+    def popAck(self):
+        entry = self.acks.popleft()
+        destination = entry["destination"]
+        if self.ackCount[destination] == 1:
+            del self.ackCount[destination]
+        else:
+            self.ackCount[destination] -= 1
+        return entry
+
+    def start(self, destination):
+        """ Moves the next pending message for destination in flight and returns it. """
+        q = self.pending[destination]
+        entry = q.popleft()
+        if not q:
+            del self.pending[destination]
+        del self.ready[priority(entry["function"])][destination]
+        self.inFlight[destination] = entry
+        return entry
+
+    def complete(self, destination):
+        """ Removes the in-flight message for destination, whether acked or given up on. """
+        entry = self.inFlight.pop(destination, None)
+        if destination in self.pending:
+            self.ready[priority(self.pending[destination][0]["function"])][destination] = True
+        return entry
+
+    def readyDestinations(self, priority, limit):
+        """ Returns up to limit destinations of the priority class, longest waiting first. """
+        return list(itertools.islice(self.ready[priority], limit))
+
+    def packFrame(self, budget, due, beacon, scan):
+        """
+        Chooses the messages for one frame and returns them in the order they are to be sent.
+        Acks are popped and new messages started, so the caller only has to send them.
+        due is the in-flight messages to retry now. Those that are not chosen are left due for the next frame.
+        No frame carries more than budget bytes, except one holding a single message longer than that.
+        Acks go first, then include_grant and start, then config, then battery requests.
+        Within a class, due retries go before new messages and nodes take turns. A message
+        goes to a node at most once a frame, and not in a frame that acks it.
+        The first message that does not fit is held for the next frame, which it goes first in,
+        so config and start messages are not passed over for ever by smaller ones. Acks fill the
+        room it leaves. If it leaves room for none, acks go first in the frame after, so neither starves.
+        In beacon frames, only acks are sent.
+        """
+        frame = []
+        sentLength = 0
+        sentAck = set()
+        retries = [[] for p in range(LOWEST_PRIORITY + 1)]
+        for entry in due:
+            retries[priority(entry["function"])].append(entry)
+        first = None
+        if not beacon and self.held is not None and not self.acksWaited and self.held not in self.ackCount:
+            first = self.takeHeld(retries)
+            self.held = None
+            if first is not None:
+                frame.append(first)
+                sentLength += first["message"]["length"]
+        self.acksWaited = False
+        while self.acks:
+            length = self.acks[0]["message"]["length"]
+            if sentLength > 0 and sentLength + length > budget:
+                self.acksWaited = not sentAck       # Only a held message can have gone before the acks
+                break
+            entry = self.popAck()
+            frame.append(entry)
+            sentAck.add(entry["destination"])
+            sentLength += length
+        if beacon:
+            for entry in due:
+                self.schedule(entry, entry["deadline"])
+            return frame
+        for p in DATA_PRIORITIES:
+            for entry in retries[p]:
+                length = entry["message"]["length"]
+                if entry["destination"] in sentAck or (sentLength > 0 and sentLength + length > budget):
+                    self.schedule(entry, entry["deadline"])     # Still due, so it is retried in the next frame
+                    if self.held is None and entry["destination"] not in sentAck:
+                        self.held = entry["destination"]
+                else:
+                    frame.append(entry)
+                    sentLength += length
+            for destination in self.readyDestinations(p, scan):
+                if destination in sentAck:
+                    continue
+                length = self.pending[destination][0]["message"]["length"]
+                if sentLength > 0 and sentLength + length > budget:
+                    if self.held is None:
+                        self.held = destination
+                    continue
+                frame.append(self.start(destination))
+                sentLength += length
+        return frame
+
+    def takeHeld(self, retries):
+        """ Returns the message for the held destination, due or ready, or None if it has none now. """
+        for entries in retries:
+            for i, entry in enumerate(entries):
+                if entry["destination"] == self.held:
+                    del entries[i]
+                    return entry
+        if self.held in self.pending and self.held not in self.inFlight:
+            return self.start(self.held)
+        return None
+
+    def schedule(self, entry, deadline):
+        """ Sets when an in-flight message should next be retried. """
+        entry["deadline"] = deadline
+        heapq.heappush(self.deadlines, (deadline, next(self.sequence), entry))
+
+    def popDue(self, now):
+        """ Removes and returns the in-flight messages whose deadline has passed, earliest first. """
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, sequence, entry = heapq.heappop(self.deadlines)
+            if self.inFlight.get(entry["destination"]) is entry and entry["deadline"] == deadline:
+                due.append(entry)
+        return due
+
+    def hasPending(self, destination):
+        return destination in self.pending or destination in self.inFlight or destination in self.ackCount
+
+    def hasUnsent(self, destination):
+        return destination in self.pending or destination in self.ackCount
+
+    def depth(self, destination):
+        depth = self.ackCount.get(destination, 0)
+        if destination in self.pending:
+            depth += len(self.pending[destination])
+        if destination in self.inFlight:
+            depth += 1
+        return depth
+
+    def takeDestination(self, destination):
+        """ Removes every message for destination and returns (acks, in-flight message or None, pending messages). """
+        acks = []
+        if destination in self.ackCount:
+            keep = collections.deque()
+            for entry in self.acks:
+                if entry["destination"] == destination:
+                    acks.append(entry)
+                else:
+                    keep.append(entry)
+            self.acks = keep
+            del self.ackCount[destination]
+        inFlight = self.inFlight.pop(destination, None)
+        pending = list(self.pending.pop(destination, ()))
+        for ready in self.ready:
+            ready.pop(destination, None)
+        return acks, inFlight, pending
+
+    def adopt(self, destination, acks, inFlight, pending):
+        """ Takes over messages returned by takeDestination on another queue, keeping their order, attempts and deadline. """
+        for entry in acks:
+            self.acks.append(entry)
+            self.ackCount[destination] = self.ackCount.get(destination, 0) + 1
+        if inFlight is not None:
+            self.inFlight[destination] = inFlight
+            if "deadline" in inFlight:
+                self.schedule(inFlight, inFlight["deadline"])
+        if pending:
+            self.pending[destination] = collections.deque(pending)
+            if inFlight is None:
+                self.ready[priority(pending[0]["function"])][destination] = True
+
+    def removeDestination(self, destination):
+        """ Drops every message for destination and returns them. """
+        acks, inFlight, pending = self.takeDestination(destination)
+        if inFlight is not None:
+            acks.append(inFlight)
+        return acks + pending
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# spur_radio.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+"""
+
+from spur_queue import RadioQueue
+
+class Radio(object):
+    """
+    One radio adaptor offering the spur characteristic. Each has its own downlink
+    queue, beacon cycle and frame budget, so airtime adds up across adaptors.
+    Nodes are served by the adaptor they were last heard on.
+    """
+    def __init__(self, adaptor):
+        self.adaptor        = adaptor       # Adaptor id, None until the first adaptor is known
+        self.queue          = RadioQueue()
+        self.nextBeacon     = None          # Frame slot of the next beacon, set on the first slot after the radio is known
+        self.frameBytes     = 0             # Bytes sent in the current frame slot
+        self.frameDestinations = set()      # Nodes sent a message in the current frame slot
+        self.configuring    = set()         # Addresses of nodes being sent config, see App.configPlace
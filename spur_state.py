@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# spur_state.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Persistence of app state as a snapshot plus an append-only journal.
+The snapshot is a pickled state dict, replaced atomically by writing a temporary
+file and renaming it. The journal holds one JSON record per line for every state
+change since the snapshot. Records only ever set or delete values, so replaying a
+journal on top of a snapshot that already includes it gives the same state.
+A snapshot is taken in two steps so that the slow part can run on a worker thread:
+rotate() moves the journal aside on the reactor thread, where records are appended,
+and writeSnapshot() writes the state and removes the old journal. Until the snapshot
+is in place, load() replays the old journal and then the new one.
+"""
+
+import os
+import json
+import pickle
+import tempfile
+
+def emptyState():
+    return {
+        "id2addr": {},
+        "addr2id": {},
+        "maxAddr": 0,
+        "released": [],         # [address, time released] waiting to be reused, oldest first
+        "buttonState": {},
+        "delivered": {}
+    }
+
+def releaseAddress(state, addr):
+    """ Takes addr off the released list now that it has been granted again. Reuse takes the oldest, so it is nearly always first. """
+    released = state["released"]
+    if released and released[0][0] == addr:
+        released.pop(0)
+    else:
+        state["released"] = [r for r in released if r[0] != addr]
+
+def applyRecord(state, record):
+    op = record[0]
+    if op == "grant":
+        nodeID, addr = record[1], record[2]
+        state["id2addr"][nodeID] = addr
+        state["addr2id"][addr] = nodeID
+        state["buttonState"][addr] = 0xFF
+        state["maxAddr"] = max(state["maxAddr"], addr)
+        releaseAddress(state, addr)
+    elif op == "remove":
+        nodeID, addr = record[1], record[2]
+        state["id2addr"].pop(nodeID, None)
+        state["addr2id"].pop(addr, None)
+        state["buttonState"].pop(addr, None)
+        state["delivered"].pop(addr, None)
+        if len(record) > 3 and not any(r[0] == addr for r in state["released"]):
+            state["released"].append([addr, record[3]])
+    elif op == "button":
+        if record[1] in state["addr2id"]:
+            state["buttonState"][record[1]] = record[2]
+    elif op == "delivered":
+        addr, item, digest = record[1], record[2], record[3]
+        state["delivered"].setdefault(addr, {})[item] = digest
+    elif op == "forget":
+        state["delivered"].pop(record[1], None)
+    else:
+        raise ValueError("Unknown journal record: " + str(op))
+
+def writeAtomic(path, data):
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+class StateJournal(object):
+    def __init__(self, snapshotFile, batchSize=32):
+        self.snapshotFile = snapshotFile
+        self.journalFile = snapshotFile + ".journal"
+        self.oldJournalFile = self.journalFile + ".old"    # Journal up to a snapshot not yet written
+        self.batchSize = batchSize
+        self.buffer = []            # Records not yet written to the journal
+        self.records = 0            # Records in the journal file
+
+    def load(self):
+        """
+        Returns the saved state with the journal replayed on top of it.
+        A torn record at the end of a journal, left by a crash, is cut off the file,
+        so that records appended after it are not joined onto it and lost on the next load.
+        """
+        state = emptyState()
+        if os.path.isfile(self.snapshotFile):
+            with open(self.snapshotFile, 'rb') as f:
+                state.update(pickle.load(f))
+        self.records = 0
+        for journalFile in (self.oldJournalFile, self.journalFile):
+            if os.path.isfile(journalFile):
+                self.records += self.replay(journalFile, state)
+        return state
+
+    def replay(self, journalFile, state):
+        """ Applies the complete records in journalFile to state, truncating any after them. Returns how many there were. """
+        records = 0
+        good = 0                    # Length of the file up to the end of the last complete record
+        with open(journalFile, 'r+b') as f:
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                applyRecord(state, record)
+                records += 1
+                good += len(line)
+            if good < os.fstat(f.fileno()).st_size:
+                f.truncate(good)
+                f.flush()
+                os.fsync(f.fileno())
+        return records
+
+    def append(self, record, sync=False):
+        """ Records are written in batches unless sync is set, in which case they are on disk on return. """
+        self.buffer.append(record)
+        if sync or len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = "".join(json.dumps(r) + "\n" for r in self.buffer)
+        with open(self.journalFile, 'a') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.records += len(self.buffer)
+        self.buffer = []
+
+    def rotate(self):
+        """ Starts a snapshot of the state as it is now. Later records go to a new journal. """
+        self.flush()
+        if os.path.isfile(self.journalFile):
+            if os.path.isfile(self.oldJournalFile):
+                # The last snapshot was not written, so its records are still needed
+                with open(self.journalFile, 'r') as f:
+                    data = f.read()
+                with open(self.oldJournalFile, 'a') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.remove(self.journalFile)
+            else:
+                os.rename(self.journalFile, self.oldJournalFile)
+        self.records = 0
+
+    def writeSnapshot(self, state):
+        """
+        state must be the state when rotate() was called. Does not touch anything rotate() or
+        append() use, so it may run on another thread. Only one snapshot may be in progress at a time.
+        """
+        writeAtomic(self.snapshotFile, pickle.dumps(state))
+        if os.path.isfile(self.oldJournalFile):
+            os.remove(self.oldJournalFile)
+
+    def snapshot(self, state):
+        """ state must include every record appended so far. """
+        self.rotate()
+        self.writeSnapshot(state)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# spur_trace.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Recording of the app's radio frames and client messages, for replay with benchmarks/replay.py.
+A trace file starts with MAGIC and holds one record per frame or message:
+body length, time, kind and source length, then the source (the adaptor id for
+radio frames, empty for client messages), then the data (the raw frame, or the
+client message as JSON). When a file reaches its size limit it is moved to
+<path>.1, older files move up one, and the oldest is dropped.
+A FRAME_CLOCK record, with no source or data, gives as its time the start of the
+app's frame clock, so that a replay can put frames in the same slots. It is written
+when the clock starts and again at the start of every later file, so it survives rotation.
+Records are written through the file's buffer, so a crash loses those since the last flush.
+"""
+
+import os
+import json
+import struct
+import base64
+
+MAGIC       = "SPURTRC1"
+RECORD      = struct.Struct(">IdBB")        # Body length, time, kind, source length
+RADIO_RX    = 1
+RADIO_TX    = 2
+CLIENT_RX   = 3
+CLIENT_TX   = 4
+FRAME_CLOCK = 5                             # Not traffic, so not in KIND_NAMES
+KIND_NAMES  = {RADIO_RX: "radio_rx", RADIO_TX: "radio_tx", CLIENT_RX: "client_rx", CLIENT_TX: "client_tx"}
+
+# Turn the arguments of a traced call into (source, data), or None to leave the call out
+def adaptorData(message):
+    if message.get("characteristic") == "spur":
+        return str(message["id"]), base64.b64decode(message["data"])
+
+def radioCommand(msg, destination):
+    if msg.get("request") == "command":
+        return str(destination), base64.b64decode(msg["data"])
+
+def clientMessage(message):
+    return "", json.dumps(message)
+
+class TraceRecorder(object):
+    def __init__(self, path, maxBytes, files, now, onError=None):
+        """
+        Keeps at most files files of about maxBytes each. now is the function giving record times.
+        If writing fails, onError is called with the exception and recording stops.
+        """
+        self.path = path
+        self.maxBytes = maxBytes
+        self.files = files
+        self.now = now
+        self.onError = onError
+        self.records = 0
+        self.epoch = None           # Trace time at which the frame clock started
+        self.f = None
+        self.open()
+
+    def open(self):
+        self.f = open(self.path, "ab")
+        self.size = self.f.tell()
+        if self.size == 0:
+            self.f.write(MAGIC)
+            self.size = len(MAGIC)
+            if self.epoch is not None:
+                self.write(self.epoch, FRAME_CLOCK, "", "")
+
+    def rotate(self):
+        self.f.close()
+        for n in range(self.files - 2, 0, -1):
+            older = self.path + "." + str(n)
+            if os.path.exists(older):
+                os.rename(older, self.path + "." + str(n + 1))     # Replaces the oldest
+        if self.files > 1:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def record(self, kind, source, data, t=None):
+        """ t defaults to now. """
+        if self.f is None:
+            return
+        try:
+            if self.size >= self.maxBytes:
+                self.rotate()
+            self.write(self.now() if t is None else t, kind, source, data)
+        except Exception as ex:
+            self.stop()
+            if self.onError:
+                self.onError(ex)
+
+    def write(self, t, kind, source, data):
+        self.f.write(RECORD.pack(len(source) + len(data), t, kind, len(source)) + source + data)
+        self.size += RECORD.size + len(source) + len(data)
+        self.records += 1
+
+    def frameClock(self, epoch):
+        """ Records that the frame clock started at epoch, in trace time. """
+        self.epoch = epoch
+        self.record(FRAME_CLOCK, "", "", epoch)
+
+    def tap(self, f, kind, encode):
+        """ Returns f wrapped so that each call is recorded before it is made. """
+        def traced(*args):
+            entry = encode(*args)
+            if entry is not None:
+                self.record(kind, *entry)
+            return f(*args)
+        return traced
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def stop(self):
+        if self.f is not None:
+            try:
+                self.f.close()
+            finally:
+                self.f = None
+
+def tracePaths(path):
+    """ Returns the trace files written at path, oldest first. """
+    paths = []
+    n = 1
+    while os.path.exists(path + "." + str(n)):
+        paths.insert(0, path + "." + str(n))
+        n += 1
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+def readTrace(paths):
+    """ Yields (time, kind, source, data) for each record in the files at paths, in order. A partly written last record is ignored. """
+    for path in paths:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Not a trace file: " + path)
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length, t, kind, sourceLength = RECORD.unpack(header)
+                body = f.read(length)
+                if len(body) < length:
+                    break
+                yield t, kind, body[:sourceLength], body[sourceLength:]
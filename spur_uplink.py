@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# spur_uplink.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Stage between the app and CbClient. Urgent messages are passed straight on.
+Low-priority messages are held for a short time, with a newer message from a
+node replacing an older one of the same function, and then flushed together.
+No message is held for longer than the flush interval. With the batch envelope,
+held messages take at most one client send per flush interval, however many
+nodes there are.
+"""
+
+import collections
+
+# When the buffer is full, the oldest message of the first function listed here that has any is dropped
+DROP_ORDER = ("next_wakeup", "woken_up", "battery")
+
+class Uplink(object):
+    def __init__(self, send, callLater, flushInterval=2, maxBuffer=256, envelope=False):
+        """
+        send is CbClient.send. If envelope is set, a flush is one client message of
+        function "batch" carrying a list of messages, otherwise each message is sent on its own.
+        """
+        self.send = send
+        self.callLater = callLater
+        self.flushInterval = flushInterval
+        self.maxBuffer = maxBuffer
+        self.envelope = envelope
+        self.buffers = collections.OrderedDict()     # Function to OrderedDict of source to message
+        self.buffered = 0
+        self.flushCall = None
+        self.counters = {
+            "immediate": 0,     # Messages passed straight on
+            "queued": 0,        # Low-priority messages accepted
+            "merged": 0,        # Messages replaced by a newer one before being sent
+            "dropped": 0,       # Messages dropped because the buffer was full
+            "flushed": 0,       # Low-priority messages sent
+            "sends": 0          # Calls to send
+        }
+
+    def __len__(self):
+        return self.buffered
+
+    def immediate(self, msg):
+        self.counters["immediate"] += 1
+        self.counters["sends"] += 1
+        self.send(msg)
+
+    def queue(self, msg, source):
+        """ Holds msg until the next flush, replacing any held message of the same function from source. """
+        self.counters["queued"] += 1
+        function = msg["function"]
+        if function not in self.buffers:
+            self.buffers[function] = collections.OrderedDict()
+        buf = self.buffers[function]
+        if source in buf:
+            del buf[source]
+            self.counters["merged"] += 1
+        else:
+            if self.buffered >= self.maxBuffer:
+                self.dropOldest()
+            self.buffered += 1
+        buf[source] = msg
+        if self.flushCall is None:
+            self.flushCall = self.callLater(self.flushInterval, self.flush)
+
+    def discard(self, function, source):
+        """ Drops any held message of function from source, for when a newer one is sent straight on. """
+        buf = self.buffers.get(function)
+        if buf and source in buf:
+            del buf[source]
+            self.buffered -= 1
+            self.counters["merged"] += 1
+
+    def dropOldest(self):
+        for function in DROP_ORDER + tuple(self.buffers.keys()):
+            if self.buffers.get(function):
+                self.buffers[function].popitem(last=False)
+                self.buffered -= 1
+                self.counters["dropped"] += 1
+                return
+
+    def flush(self):
+        self.flushCall = None
+        messages = []
+        for buf in self.buffers.values():
+            messages.extend(buf.values())
+        self.buffers.clear()
+        self.buffered = 0
+        if not messages:
+            return
+        self.counters["flushed"] += len(messages)
+        if self.envelope:
+            self.counters["sends"] += 1
+            self.send({"function": "batch", "messages": messages})
+        else:
+            for msg in messages:
+                self.counters["sends"] += 1
+                self.send(msg)
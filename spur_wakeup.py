@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# spur_wakeup.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Per-node choice of how long a node sleeps before it next wakes up.
+A node only hears the bridge when it wakes, so the sleep interval bounds how long
+config pushed from the cloud waits. Nodes that were pressed recently, or whose
+config the cloud changes often, are woken more often. A per-node budget of wakeups
+a day, smaller when the battery is low, sets the shortest interval allowed.
+Intervals are in the units sent to the node, seconds/2.
+"""
+
+DAY = 24*60*60
+
+class WakeupPolicy(object):
+    def __init__(self, shortest, longest, pressFactor=0.5, pushFactor=0.25, pushWeight=0.3,
+                 wakeupsPerDay=96, lowWakeupsPerDay=6, batteryFull=2.8, batteryLow=2.4):
+        """
+        shortest and longest bound the interval, in seconds/2.
+        After a press the interval is pressFactor times the time since the press.
+        For nodes whose config is pushed repeatedly, the interval is pushFactor times the
+        mean time between pushes, a moving average with weight pushWeight on the newest gap.
+        The wakeup budget falls linearly from wakeupsPerDay with the battery at batteryFull
+        to lowWakeupsPerDay at batteryLow, in volts. Nodes that have not reported a
+        battery level get the full budget.
+        """
+        self.shortest = shortest
+        self.longest = longest
+        self.pressFactor = pressFactor
+        self.pushFactor = pushFactor
+        self.pushWeight = pushWeight
+        self.wakeupsPerDay = wakeupsPerDay
+        self.lowWakeupsPerDay = lowWakeupsPerDay
+        self.batteryFull = batteryFull
+        self.batteryLow = batteryLow
+
+    def pressed(self, node, now):
+        node.lastPress = now
+
+    def pushed(self, node, now):
+        if node.lastPush is not None:
+            gap = now - node.lastPush
+            if node.pushGap is None:
+                node.pushGap = gap
+            else:
+                node.pushGap += self.pushWeight * (gap - node.pushGap)
+        node.lastPush = now
+
+    def battery(self, node, level):
+        node.battery = level
+
+    def budget(self, node):
+        """ Wakeups a day the node may spend. """
+        if node.battery is None or node.battery >= self.batteryFull:
+            return self.wakeupsPerDay
+        if node.battery <= self.batteryLow:
+            return self.lowWakeupsPerDay
+        fraction = (node.battery - self.batteryLow) / (self.batteryFull - self.batteryLow)
+        return self.lowWakeupsPerDay + fraction * (self.wakeupsPerDay - self.lowWakeupsPerDay)
+
+    def interval(self, node, now):
+        """ Returns the interval, in seconds/2, for a node that has nothing waiting for it. """
+        seconds = 2.0 * self.longest
+        if node.lastPress is not None:
+            seconds = min(seconds, self.pressFactor * (now - node.lastPress))
+        if node.pushGap is not None and now - node.lastPush < 4 * node.pushGap:
+            seconds = min(seconds, self.pushFactor * node.pushGap)
+        seconds = max(seconds, float(DAY) / self.budget(node))
+        return int(min(max(seconds / 2, self.shortest), self.longest))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# test_address.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of radio address allocation in spur_address.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_address import AddressAllocator, AddressesExhausted, MAX_ADDRESS
+
+QUARANTINE = 600
+RESERVED = [(0x0000, 0x0000), (0xBBBB, 0xBBBB), (0xF000, 0xFFFF)]
+
+class AddressAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.addresses = AddressAllocator(RESERVED, QUARANTINE)
+
+    def test_new_addresses_in_order(self):
+        self.assertEqual([self.addresses.allocate(0) for i in range(3)], [1, 2, 3])
+
+    def test_reserved_skipped(self):
+        addresses = AddressAllocator(RESERVED, QUARANTINE, maxAddr=0xBBBA)
+        self.assertEqual(addresses.allocate(0), 0xBBBC)
+        addresses.release(0xBBBB, 0)
+        self.assertEqual(len(addresses), 0)
+
+    def test_quarantine(self):
+        a = self.addresses
+        first = a.allocate(0)
+        a.allocate(0)
+        a.release(first, 100)
+        self.assertEqual(a.allocate(100 + QUARANTINE - 1), 3)     # Still in quarantine
+        self.assertEqual(a.allocate(100 + QUARANTINE), first)
+        self.assertEqual(len(a), 0)
+
+    def test_oldest_released_reused_first(self):
+        a = self.addresses
+        for i in range(4):
+            a.allocate(0)
+        a.release(3, 10)
+        a.release(1, 20)
+        a.release(4, 30)
+        now = 30 + QUARANTINE
+        self.assertEqual([a.allocate(now) for i in range(4)], [3, 1, 4, 5])
+
+    def test_state_round_trip(self):
+        a = self.addresses
+        for i in range(3):
+            a.allocate(0)
+        a.release(2, 50)
+        maxAddr, released = a.state()
+        b = AddressAllocator(RESERVED, QUARANTINE, maxAddr, released)
+        self.assertEqual(b.allocate(50), 4)
+        self.assertEqual(b.allocate(50 + QUARANTINE), 2)
+
+    def test_exhausted(self):
+        addresses = AddressAllocator([], QUARANTINE, maxAddr=MAX_ADDRESS - 1)
+        last = addresses.allocate(0)
+        self.assertEqual(last, MAX_ADDRESS)
+        addresses.release(last, 0)
+        self.assertRaises(AddressesExhausted, addresses.allocate, 1)
+        self.assertEqual(addresses.allocate(QUARANTINE), MAX_ADDRESS)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# test_clock.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of frame slot timing in spur_clock.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_clock import FrameClock
+
+EPOCH = 1000.0
+
+class FrameClockTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FrameClock(1.0, EPOCH)
+
+    def test_slots_keep_phase(self):
+        """ Late slots do not push later ones back, so slots stay on their boundaries. """
+        clock = self.clock
+        self.assertEqual(clock.delay(EPOCH - 0.25), 0.25)
+        self.assertEqual(clock.tick(EPOCH), (0, 0.0, 0))
+        self.assertEqual(clock.delay(EPOCH + 0.25), 0.75)
+        slot, lag, missed = clock.tick(EPOCH + 1.3)
+        self.assertEqual((slot, missed), (1, 0))
+        self.assertAlmostEqual(lag, 0.3)
+        self.assertAlmostEqual(clock.delay(EPOCH + 1.3), 0.7)
+        self.assertEqual(clock.boundary(2), EPOCH + 2.0)
+
+    def test_early_tick(self):
+        clock = self.clock
+        clock.tick(EPOCH)
+        self.assertIsNone(clock.tick(EPOCH + 0.4))
+        slot, lag, missed = clock.tick(EPOCH + 0.6)        # A timer firing a little early still runs the slot
+        self.assertEqual((slot, missed), (1, 0))
+        self.assertAlmostEqual(lag, -0.4)
+        self.assertAlmostEqual(clock.delay(EPOCH + 0.6), 1.4)
+
+    def test_missed_slots_skipped(self):
+        clock = self.clock
+        clock.tick(EPOCH)
+        slot, lag, missed = clock.tick(EPOCH + 4.2)
+        self.assertEqual((slot, missed), (4, 3))
+        self.assertAlmostEqual(lag, 0.2)
+        self.assertEqual(clock.tick(EPOCH + 5.0), (5, 0.0, 0))
+
+    def test_no_drift(self):
+        """ Small lags on every slot do not add up. """
+        clock = self.clock
+        for slot in range(1000):
+            now = clock.boundary(slot) + 0.05
+            self.assertEqual(clock.tick(now)[0], slot)
+            self.assertAlmostEqual(clock.delay(now), 0.95)
+
+if __name__ == '__main__':
+    unittest.main()
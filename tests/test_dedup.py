@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# test_dedup.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of resend detection in spur_dedup.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_dedup import DuplicateFilter
+from spur_nodes import Node
+
+def alert(source, alertType):
+    return struct.pack(">HHBBIH", 0, source, 0x09, 6, 0, alertType)
+
+class DuplicateFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.filter = DuplicateFilter(5)
+        self.node = Node(0x10000001)
+
+    def test_copy_within_window(self):
+        self.assertFalse(self.filter.isDuplicate(self.node, alert(1, 0), 100.0))
+        self.assertTrue(self.filter.isDuplicate(self.node, alert(1, 0), 103.0))
+        self.assertFalse(self.filter.isDuplicate(self.node, alert(1, 1), 103.5))
+
+    def test_window_runs_from_first_copy(self):
+        """ Copies inside the window do not extend it, so identical frames are only held back for one window. """
+        self.assertFalse(self.filter.isDuplicate(self.node, alert(1, 0), 100.0))
+        self.assertTrue(self.filter.isDuplicate(self.node, alert(1, 0), 103.0))
+        self.assertTrue(self.filter.isDuplicate(self.node, alert(1, 0), 105.0))
+        self.assertFalse(self.filter.isDuplicate(self.node, alert(1, 0), 106.0))
+        self.assertTrue(self.filter.isDuplicate(self.node, alert(1, 0), 109.0))
+        self.assertFalse(self.filter.isDuplicate(self.node, alert(1, 0), 111.5))
+
+    def test_nodes_kept_apart(self):
+        other = Node(0x10000002)
+        self.assertFalse(self.filter.isDuplicate(self.node, alert(1, 0), 100.0))
+        self.assertFalse(self.filter.isDuplicate(other, alert(2, 0), 100.5))
+
+    def test_unknown_source(self):
+        frame = alert(0, 0)
+        self.assertFalse(self.filter.isDuplicate(None, frame, 100.0))
+        self.assertFalse(self.filter.isDuplicate(None, frame, 101.0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# test_display.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Golden tests of screen rendering in spur_display. The full payloads are the bytes
+the app sent before ScreenEncoder, and the compact ones are checked against them.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import base64
+import binascii
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_display import renderScreen, RenderCache
+
+# (screen, text, full payload, compact payload), payloads in hex
+SCREENS = (
+    (1, "Press for service",
+        "53015200460259264312507265737320666f72207365727669636500004553",
+        "53015200460259264312507265737320666f72207365727669636500004553"),
+    (2, "Yes | No",
+        "53025200460259266c045965730000592672034e6f00005801590142625c5802590242605a5865590142625c5866590242605a4553",
+        "53025200460259266c04596573000072034e6f00005801590142625c586542625c5802590242605a586642605a4553"),
+    (3, "Meeting room\nCoffee | Tea\nWater | Snacks",
+        "530352004602590a430d4d656574696e6720726f6f6d000059286c07436f66666565000059287204546561000059466c06576174"
+        "657200005946720753" "6e61636b7300005801591e4262405802591f42603e5865591e4262405866591f42603e4553",
+        "530352004602590a430d4d656574696e6720726f6f6d000059286c07436f6666656500007204546561000059466c0657617465"
+        "7200007207536e61636b7300005801591e42624058654262405802591f42603e586642603e4553"),
+    (5, "Left | \nTwo\nThree\n | Right",
+        "53055200460259046c054c6566740000590472010000591a430454776f0000593043065468726565000059466c010000594672"
+        "06526967687400005801590142625c5802590242605a5865590142625c5866590242605a4553",
+        "53055200460259046c054c6566740000591a430454776f00005930430654687265650000594672065269676874000058015901"
+        "42625c586542625c5802590242605a586642605a4553"),
+)
+
+def hexPayload(screen, text, compact):
+    return binascii.hexlify(renderScreen(screen, base64.b64encode(text.encode()), compact)).decode()
+
+class ScreenTest(unittest.TestCase):
+    def test_full_payloads_unchanged(self):
+        for screen, text, full, compact in SCREENS:
+            self.assertEqual(hexPayload(screen, text, False), full, text)
+
+    def test_compact_payloads(self):
+        for screen, text, full, compact in SCREENS:
+            self.assertEqual(hexPayload(screen, text, True), compact, text)
+
+    def test_compact_never_longer(self):
+        for screen, text, full, compact in SCREENS:
+            self.assertTrue(len(compact) <= len(full), text)
+
+    def test_saving_reported_either_way(self):
+        """ The cache reports what compact rendering saves whether or not it is used. """
+        screen, text, full, compact = SCREENS[3]
+        saving = (len(full) - len(compact)) // 2
+        value = base64.b64encode(text.encode())
+        for useCompact, payload in ((False, full), (True, compact)):
+            cache = RenderCache(8, useCompact)
+            digest, rendered, saved = cache.renderWithDigest("D5", value)
+            self.assertEqual(binascii.hexlify(rendered).decode(), payload)
+            self.assertEqual(saved, saving)
+            self.assertEqual(cache.renderWithDigest("D5", value)[1:], (rendered, saving))
+            self.assertEqual(cache.renderWithDigest("app_value", 3)[2], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# test_log.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the per-subsystem levels in spur_log.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_log import SubsystemLog, LEVELS, RADIO_RX, QUEUE, CONFIG
+
+class SubsystemLogTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.log = SubsystemLog(lambda level, message: self.lines.append((level, message)), "info")
+
+    def test_debug_gated_per_subsystem(self):
+        self.log.setLevels("info", {"queue": "DEBUG"})
+        self.log.debug(QUEUE, "queue {}", 1)
+        self.log.debug(RADIO_RX, "radio {}", lambda: 1/0)     # Not emitted, so the argument is never called
+        self.assertEqual(self.lines, [("debug", "queue 1")])
+
+    def test_bad_level_leaves_levels_unchanged(self):
+        self.log.setLevels("warning", {"queue": "debug"})
+        for level, levels in (("verbose", None), ("debug", {"config": "debug", "queue": "verbose"})):
+            self.assertRaises(KeyError, self.log.setLevels, level, levels)
+            self.assertEqual(self.log.thresholds[CONFIG], LEVELS["warning"])
+            self.assertEqual(self.log.thresholds[QUEUE], LEVELS["debug"])
+            self.assertFalse(self.log.debugEnabled[CONFIG])
+            self.assertTrue(self.log.debugEnabled[QUEUE])
+
+if __name__ == '__main__':
+    unittest.main()
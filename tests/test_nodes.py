@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# test_nodes.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the node table in spur_nodes.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_nodes import NodeTable
+
+class NodeTableTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = NodeTable()
+
+    def test_including_node_has_no_address(self):
+        node = self.nodes.include(0x10000001)
+        self.assertTrue(node.including)
+        self.assertIs(self.nodes.byID[0x10000001], node)
+        self.assertEqual(len(self.nodes), 0)
+        self.assertIs(self.nodes.include(0x10000001), node)
+
+    def test_assign(self):
+        node = self.nodes.include(0x10000001)
+        self.assertIs(self.nodes.assign(0x10000001, 5), node)
+        self.assertIs(self.nodes.get(5), node)
+        self.assertEqual(node.addr, 5)
+        self.assertEqual(list(self.nodes), [node])
+        self.assertIsNone(self.nodes.get(6))
+
+    def test_unassign_clears_node(self):
+        node = self.nodes.assign(0x10000001, 5)
+        node.buttonState = 0x01
+        node.config = {"app_value": 3}
+        node.delivered = {"name": "abc"}
+        node.sendingConfig = True
+        self.nodes.unassign(node)
+        self.assertIsNone(self.nodes.get(5))
+        self.assertNotIn(0x10000001, self.nodes.byID)
+        self.assertIsNone(node.addr)
+        self.assertEqual(node.buttonState, 0xFF)
+        self.assertIsNone(node.config)
+        self.assertIsNone(node.delivered)
+        self.assertFalse(node.sendingConfig)
+
+    def test_unassign_keeps_including_node(self):
+        """ A node asking to be included again loses its old address but stays in the id index. """
+        node = self.nodes.assign(0x10000001, 5)
+        self.nodes.include(0x10000001)
+        self.nodes.unassign(node)
+        self.assertIs(self.nodes.byID[0x10000001], node)
+        self.assertEqual(len(self.nodes), 0)
+
+    def test_state_round_trip(self):
+        self.nodes.include(0x10000003)
+        a = self.nodes.assign(0x10000001, 5)
+        a.buttonState = 0x01
+        a.delivered = {"name": "abc"}
+        self.nodes.assign(0x10000002, 6)
+        state = self.nodes.state()
+        self.assertEqual(state["id2addr"], {0x10000001: 5, 0x10000002: 6})
+        self.assertEqual(state["addr2id"], {5: 0x10000001, 6: 0x10000002})
+        self.assertEqual(state["buttonState"], {5: 0x01, 6: 0xFF})
+        self.assertEqual(state["delivered"], {5: {"name": "abc"}})
+        loaded = NodeTable()
+        loaded.load(state)
+        self.assertEqual(loaded.state(), state)
+        self.assertNotIn(0x10000003, loaded.byID)     # Including nodes are not saved
+        self.assertEqual(loaded.get(5).delivered, {"name": "abc"})
+
+if __name__ == '__main__':
+    unittest.main()
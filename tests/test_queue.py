@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# test_queue.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the downlink queue in spur_queue.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_queue import RadioQueue
+
+BUDGET = 120
+SCAN = 32
+
+def message(length):
+    return {"length": length}
+
+def functions(frame):
+    return [(m["function"], m["destination"]) for m in frame]
+
+class RadioQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = RadioQueue()
+
+    def test_one_in_flight_per_destination(self):
+        q = self.queue
+        q.push(message(20), 1, "config")
+        q.push(message(20), 1, "config")
+        q.push(message(12), 1, "ack")
+        self.assertEqual(q.depth(1), 3)
+        first = q.start(1)
+        self.assertEqual(q.inFlight, {1: first})
+        self.assertTrue(q.hasUnsent(1))
+        self.assertIs(q.complete(1), first)
+        q.start(1)
+        q.popAck()
+        self.assertFalse(q.hasUnsent(1))
+        self.assertTrue(q.hasPending(1))
+        q.complete(1)
+        self.assertFalse(q.hasPending(1))
+        self.assertEqual(len(q), 0)
+
+    def test_remove_destination(self):
+        q = self.queue
+        q.push(message(12), 1, "ack")
+        q.push(message(20), 1, "config")
+        q.push(message(20), 1, "config")
+        q.push(message(12), 2, "ack")
+        q.start(1)
+        self.assertEqual(len(q.removeDestination(1)), 3)
+        self.assertEqual([m["destination"] for m in q.acks], [2])
+        self.assertEqual(q.depth(1), 0)
+        self.assertFalse(q.hasPending(1))
+
+    def test_due_in_deadline_order(self):
+        q = self.queue
+        for destination, deadline in ((1, 30.0), (2, 10.0), (3, 20.0)):
+            q.push(message(20), destination, "config")
+            q.schedule(q.start(destination), deadline)
+        self.assertEqual([m["destination"] for m in q.popDue(25.0)], [2, 3])
+        self.assertEqual(q.popDue(25.0), [])
+
+    def test_acked_and_rescheduled_entries_skipped(self):
+        q = self.queue
+        q.push(message(20), 1, "config")
+        q.push(message(20), 2, "config")
+        q.schedule(q.start(1), 10.0)
+        entry = q.start(2)
+        q.schedule(entry, 10.0)
+        q.schedule(entry, 30.0)
+        q.complete(1)
+        self.assertEqual(q.popDue(20.0), [])
+        self.assertEqual(q.popDue(30.0), [entry])
+
+    def test_priority_rings(self):
+        """ Each class is a ring in the order nodes became ready, and a node rejoins at the back. """
+        q = self.queue
+        for destination in (1, 2, 3):
+            q.push(message(20), destination, "config")
+        q.push(message(20), 4, "include_grant")
+        q.push(message(20), 5, "send_battery")
+        self.assertEqual(q.readyDestinations(1, SCAN), [4])
+        self.assertEqual(q.readyDestinations(2, SCAN), [1, 2, 3])
+        self.assertEqual(q.readyDestinations(2, 2), [1, 2])
+        self.assertEqual(q.readyDestinations(3, SCAN), [5])
+        q.push(message(20), 1, "start")
+        q.start(1)
+        self.assertEqual(q.readyDestinations(2, SCAN), [2, 3])
+        q.complete(1)
+        self.assertEqual(q.readyDestinations(1, SCAN), [4, 1])
+        q.push(message(20), 2, "config")
+        q.start(2)
+        q.complete(2)
+        self.assertEqual(q.readyDestinations(2, SCAN), [3, 2])
+
+    def test_pack_order(self):
+        q = self.queue
+        q.push(message(30), 1, "config")
+        q.push(message(30), 2, "send_battery")
+        q.push(message(30), 3, "include_grant")
+        q.push(message(12), 4, "ack")
+        q.push(message(12), 1, "ack")
+        self.assertEqual(functions(q.packFrame(BUDGET, [], False, SCAN)),
+            [("ack", 4), ("ack", 1), ("include_grant", 3), ("send_battery", 2)])
+        self.assertEqual(functions(q.packFrame(BUDGET, [], False, SCAN)), [("config", 1)])
+
+    def test_beacon_frame_only_acks(self):
+        q = self.queue
+        q.push(message(30), 1, "config")
+        q.push(message(12), 2, "ack")
+        self.assertEqual(functions(q.packFrame(BUDGET, [], True, SCAN)), [("ack", 2)])
+        self.assertEqual(functions(q.packFrame(BUDGET, [], False, SCAN)), [("config", 1)])
+
+    def test_held_message_goes_first(self):
+        """ A message that does not fit is sent first in the next frame rather than passed over by smaller ones. """
+        q = self.queue
+        q.push(message(60), 1, "include_grant")
+        q.push(message(100), 2, "config")
+        for destination in range(3, 10):
+            q.push(message(20), destination, "config")
+        self.assertEqual(functions(q.packFrame(BUDGET, [], False, SCAN)),
+            [("include_grant", 1), ("config", 3), ("config", 4), ("config", 5)])
+        for destination in range(10, 20):
+            q.push(message(12), destination, "ack")
+        frame = q.packFrame(BUDGET, [], False, SCAN)
+        self.assertEqual(functions(frame)[0], ("config", 2))
+        self.assertEqual(sum(m["message"]["length"] for m in frame), 112)
+
+    def test_held_retry_goes_first(self):
+        q = self.queue
+        q.push(message(100), 1, "config")
+        retry = q.start(1)
+        q.schedule(retry, 10.0)
+        q.push(message(30), 2, "include_grant")
+        self.assertEqual(functions(q.packFrame(BUDGET, q.popDue(10.0), False, SCAN)), [("include_grant", 2)])
+        q.push(message(30), 3, "include_grant")
+        self.assertEqual(functions(q.packFrame(BUDGET, q.popDue(11.0), False, SCAN)), [("config", 1)])
+
+    def test_acks_not_starved(self):
+        """ When a held message leaves no room for an ack, acks go first in the next frame. """
+        q = self.queue
+        for destination in range(1, 41):
+            q.push(message(110), destination, "config")
+        configs = 0
+        for frame in range(20):
+            q.push(message(12), 100 + frame, "ack")
+            sent = functions(q.packFrame(BUDGET, [], False, SCAN))
+            configs += len([m for m in sent if m[0] == "config"])
+            self.assertTrue(len(q.acks) <= 1, (frame, sent))
+        self.assertTrue(configs >= 9, configs)
+
+    def test_oversized_message_sent_alone(self):
+        q = self.queue
+        q.push(message(12), 1, "ack")
+        q.push(message(150), 2, "config")
+        q.push(message(20), 3, "config")
+        self.assertEqual(functions(q.packFrame(BUDGET, [], False, SCAN)), [("ack", 1), ("config", 3)])
+        self.assertEqual(functions(q.packFrame(BUDGET, [], False, SCAN)), [("config", 2)])
+
+    def test_frames_within_budget(self):
+        """ Under a random load no frame is over budget, except one carrying a single longer message. """
+        q = self.queue
+        rng = random.Random(7)
+        for slot in range(2000):
+            for i in range(rng.randint(0, 3)):
+                destination = rng.randint(1, 40)
+                function = rng.choice(("ack", "ack", "include_grant", "start", "config", "config", "send_battery"))
+                length = 12 if function == "ack" else rng.choice((14, 18, 29, 83, 92, 110, 125))
+                q.push(message(length), destination, function)
+            due = []
+            for entry in q.popDue(slot):
+                if rng.random() < 0.2:
+                    q.complete(entry["destination"])     # Given up on
+                else:
+                    due.append(entry)
+            frame = q.packFrame(BUDGET, due, slot % 7 == 0, SCAN)
+            length = sum(m["message"]["length"] for m in frame)
+            self.assertTrue(length <= BUDGET or len(frame) == 1, (slot, functions(frame), length))
+            self.assertEqual(len(set(m["destination"] for m in frame if m["function"] != "ack")),
+                len([m for m in frame if m["function"] != "ack"]))
+            for m in frame:
+                if m["function"] != "ack":
+                    q.schedule(m, slot + rng.randint(1, 9))
+            for destination in list(q.inFlight):
+                if rng.random() < 0.3:
+                    q.complete(destination)
+
+    def test_rehome_keeps_state(self):
+        q = self.queue
+        other = RadioQueue()
+        q.push(message(12), 1, "ack")
+        q.push(message(20), 1, "config")
+        q.push(message(20), 1, "start")
+        entry = q.start(1)
+        entry["attempt"] = 2
+        q.schedule(entry, 15.0)
+        other.adopt(1, *q.takeDestination(1))
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.popDue(20.0), [])
+        self.assertEqual(other.depth(1), 3)
+        self.assertEqual(other.popDue(20.0), [entry])
+        self.assertEqual(entry["attempt"], 2)
+        other.complete(1)
+        self.assertEqual(other.readyDestinations(1, SCAN), [1])
+
+if __name__ == '__main__':
+    unittest.main()
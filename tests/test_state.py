@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# test_state.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the snapshot and journal in spur_state.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_state import StateJournal
+
+class TornJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="spur_state_test_")
+        self.snapshotFile = os.path.join(self.dir, "app.savestate")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def crash(self, journalFile, torn):
+        """ Leaves journalFile as a crash part way through writing a record would. """
+        with open(journalFile, 'ab') as f:
+            f.write(torn)
+
+    def assertGranted(self, state, grants):
+        self.assertEqual(state["addr2id"], dict((addr, nodeID) for nodeID, addr in grants))
+        self.assertEqual(state["maxAddr"], max(addr for nodeID, addr in grants))
+
+    def test_append_after_torn_record(self):
+        journal = StateJournal(self.snapshotFile)
+        journal.append(["grant", 1, 1])
+        journal.append(["grant", 2, 2], sync=True)
+        self.crash(journal.journalFile, b'["grant", 3, ')
+        journal = StateJournal(self.snapshotFile)
+        self.assertGranted(journal.load(), [(1, 1), (2, 2)])
+        journal.append(["grant", 4, 3])
+        journal.append(["grant", 5, 4], sync=True)
+        state = StateJournal(self.snapshotFile).load()
+        self.assertGranted(state, [(1, 1), (2, 2), (4, 3), (5, 4)])
+
+    def test_record_without_newline(self):
+        journal = StateJournal(self.snapshotFile)
+        journal.append(["grant", 1, 1], sync=True)
+        self.crash(journal.journalFile, b'["grant", 2, 2]')
+        journal = StateJournal(self.snapshotFile)
+        self.assertGranted(journal.load(), [(1, 1)])
+        journal.append(["grant", 3, 2], sync=True)
+        self.assertGranted(StateJournal(self.snapshotFile).load(), [(1, 1), (3, 2)])
+
+    def test_torn_old_journal(self):
+        """ A crash after rotate() and before the snapshot is written leaves the old journal to replay. """
+        journal = StateJournal(self.snapshotFile)
+        journal.append(["grant", 1, 1], sync=True)
+        journal.rotate()
+        self.crash(journal.oldJournalFile, b'["grant", 2')
+        journal.append(["grant", 3, 2], sync=True)
+        journal = StateJournal(self.snapshotFile)
+        self.assertGranted(journal.load(), [(1, 1), (3, 2)])
+        journal.rotate()
+        journal.append(["grant", 4, 3], sync=True)
+        self.assertGranted(StateJournal(self.snapshotFile).load(), [(1, 1), (3, 2), (4, 3)])
+
+    def test_snapshot_then_journal(self):
+        journal = StateJournal(self.snapshotFile)
+        journal.append(["grant", 1, 1], sync=True)
+        journal.snapshot(journal.load())
+        journal.append(["remove", 1, 1, 100.0], sync=True)
+        state = StateJournal(self.snapshotFile).load()
+        self.assertEqual(state["addr2id"], {})
+        self.assertEqual(state["released"], [[1, 100.0]])
+
+if __name__ == '__main__':
+    unittest.main()
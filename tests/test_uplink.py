@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# test_uplink.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the merging, dropping and flushing of held client messages in spur_uplink.
+Run from the top of the tree with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_uplink import Uplink
+
+class UplinkTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.calls = []
+
+    def callLater(self, delay, f):
+        self.calls.append((delay, f))
+        return f
+
+    def uplink(self, maxBuffer=8, envelope=False):
+        return Uplink(self.sent.append, self.callLater, 2, maxBuffer, envelope)
+
+    def flush(self):
+        delay, f = self.calls.pop(0)
+        self.assertEqual(delay, 2)
+        f()
+
+    def test_immediate(self):
+        uplink = self.uplink()
+        uplink.immediate({"function": "alert", "source": 1})
+        self.assertEqual(self.sent, [{"function": "alert", "source": 1}])
+        self.assertEqual(self.calls, [])
+
+    def test_newer_message_replaces_held_one(self):
+        uplink = self.uplink()
+        uplink.queue({"function": "battery", "source": 1, "value": 2.9}, 1)
+        uplink.queue({"function": "battery", "source": 2, "value": 2.8}, 2)
+        uplink.queue({"function": "woken_up", "source": 1}, 1)
+        uplink.queue({"function": "battery", "source": 1, "value": 2.7}, 1)
+        self.assertEqual(len(uplink), 3)
+        self.assertEqual(len(self.calls), 1)        # One flush for everything held
+        self.flush()
+        self.assertEqual(self.sent, [
+            {"function": "battery", "source": 2, "value": 2.8},
+            {"function": "battery", "source": 1, "value": 2.7},
+            {"function": "woken_up", "source": 1}
+        ])
+        self.assertEqual(uplink.counters["merged"], 1)
+        self.assertEqual(uplink.counters["flushed"], 3)
+        self.assertEqual(len(uplink), 0)
+
+    def test_drop_order(self):
+        """ A full buffer drops the oldest next_wakeup, then woken_up, then battery, then anything else. """
+        uplink = self.uplink(maxBuffer=4)
+        uplink.queue({"function": "config_progress", "id": "p1"}, "p1")
+        uplink.queue({"function": "battery", "source": 1}, 1)
+        uplink.queue({"function": "woken_up", "source": 1}, 1)
+        uplink.queue({"function": "woken_up", "source": 2}, 2)
+        uplink.queue({"function": "next_wakeup", "source": 1}, 1)
+        uplink.queue({"function": "next_wakeup", "source": 2}, 2)
+        uplink.queue({"function": "battery", "source": 2}, 2)
+        uplink.queue({"function": "battery", "source": 3}, 3)
+        uplink.queue({"function": "woken_up", "source": 3}, 3)
+        uplink.queue({"function": "config_progress", "id": "p2"}, "p2")
+        uplink.queue({"function": "config_progress", "id": "p3"}, "p3")
+        self.assertEqual(len(uplink), 4)
+        self.assertEqual(uplink.counters["dropped"], 7)
+        self.flush()
+        self.assertEqual(self.sent, [
+            {"function": "config_progress", "id": "p1"},
+            {"function": "config_progress", "id": "p2"},
+            {"function": "config_progress", "id": "p3"},
+            {"function": "battery", "source": 3}
+        ])
+
+    def test_discard(self):
+        uplink = self.uplink()
+        uplink.queue({"function": "config_progress", "id": "p1", "done": 1}, "p1")
+        uplink.discard("config_progress", "p1")
+        uplink.discard("config_progress", "p2")
+        self.assertEqual(len(uplink), 0)
+        self.flush()
+        self.assertEqual(self.sent, [])
+
+    def test_batch_once_per_flush_interval(self):
+        uplink = self.uplink(envelope=True)
+        for source in range(5):
+            uplink.queue({"function": "woken_up", "source": source}, source)
+        self.assertEqual(len(self.calls), 1)
+        self.flush()
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0]["function"], "batch")
+        self.assertEqual([m["source"] for m in self.sent[0]["messages"]], list(range(5)))
+        self.assertEqual(uplink.counters["sends"], 1)
+        uplink.queue({"function": "woken_up", "source": 1}, 1)
+        self.assertEqual(len(self.calls), 1)        # The next message starts a new interval
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# test_wakeup.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the sleep intervals chosen by spur_wakeup.
+Run from the top of the tree with: python -m unittest discover tests
+Intervals are in seconds/2, as sent to the node.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from spur_wakeup import WakeupPolicy, DAY
+from spur_nodes import Node
+
+SHORTEST = 5*60
+LONGEST = 2*60*60
+
+class WakeupPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = WakeupPolicy(SHORTEST, LONGEST)
+        self.node = Node(0x10000001)
+        self.now = 1.0e9
+
+    def test_idle_node_sleeps_longest(self):
+        self.assertEqual(self.policy.interval(self.node, self.now), LONGEST)
+
+    def test_press_long_ago_sleeps_longest(self):
+        self.policy.pressed(self.node, self.now - 10*DAY)
+        self.assertEqual(self.policy.interval(self.node, self.now), LONGEST)
+
+    def test_press_scales_interval(self):
+        self.policy.pressed(self.node, self.now - 60*60)
+        self.assertEqual(self.policy.interval(self.node, self.now), int(0.5 * 60*60 / 2))
+
+    def test_recent_press_held_to_wakeup_budget(self):
+        """ The budget of 96 wakeups a day, not shortest, is the floor for a node with a full battery. """
+        self.policy.pressed(self.node, self.now - 1)
+        self.assertEqual(self.policy.interval(self.node, self.now), int(DAY / 96.0 / 2))
+
+    def test_shortest_bound(self):
+        policy = WakeupPolicy(SHORTEST, LONGEST, wakeupsPerDay=10000)
+        policy.pressed(self.node, self.now - 1)
+        self.assertEqual(policy.interval(self.node, self.now), SHORTEST)
+
+    def test_low_battery_budget(self):
+        self.policy.pressed(self.node, self.now - 1)
+        self.policy.battery(self.node, 2.0)
+        self.assertEqual(self.policy.interval(self.node, self.now), LONGEST)   # 6 a day is longer than LONGEST
+        self.policy.battery(self.node, 2.6)
+        self.assertEqual(self.policy.interval(self.node, self.now), int(DAY / 51.0 / 2))
+
+    def test_pushes(self):
+        for t in range(0, 4*60*60, 60*60):
+            self.policy.pushed(self.node, self.now + t)
+        now = self.now + 3*60*60
+        self.assertEqual(self.policy.interval(self.node, now), int(0.25 * 60*60 / 2))
+        self.assertEqual(self.policy.interval(self.node, now + 4*60*60 + 1), LONGEST)   # Pushes have stopped
+
+if __name__ == '__main__':
+    unittest.main()